@@ -0,0 +1,316 @@
+"""JSON HTTP API over the library.
+
+Serves the app's data paths (paged and filtered lists, search, statistics,
+add, toggle, remove) from any storage backend, for scripts and other
+services that should not scrape the UI or query the database directly.
+
+    python api.py --mongo-uri "$DATABASE" --port 8080
+    python api.py --backend sqlite --sqlite library.db
+    python api.py --backend json --token "$LIBRARY_API_TOKEN"
+
+    GET    /books?status=Read&genre=Fiction&sort=Added&page=2&page_size=25
+    GET    /books/search?q=dune&by=title&limit=20
+    GET    /genres
+    GET    /stats
+    POST   /books                  {"title", "author", "year", "genre", "read"}; 409 if already there
+    POST   /books/{id}/toggle
+    DELETE /books/{id}
+    GET    /metrics                Prometheus text format
+
+GET responses carry an ETag made of the library version, which the change
+feed moves whenever any process changes a book. A request whose
+If-None-Match still matches gets a 304 without a backend query. Larger
+responses are gzip-compressed for clients that accept it. Backend calls
+are blocking, so they run on a thread pool while the event loop keeps
+accepting requests.
+"""
+import argparse
+import asyncio
+import hmac
+import json
+import os
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+
+from books import SORT_OPTIONS, new_book, validate_book
+from changefeed import start_change_feed
+from storage import (
+    SEARCH_LIMIT, BookRecord, DuplicateBookError, JsonBackend, MongoBackend, SqliteBackend, duplicate_message, encode_book,
+)
+from telemetry import Telemetry
+
+
+API_WORKERS = 32
+MAX_PAGE_SIZE = 500
+GZIP_MIN_BYTES = 1024
+FILTER_STATUSES = ["All", "Read", "Unread"]
+SEARCH_BY = ["all", "title", "author", "year", "genre"]
+
+
+def public_book(book):
+    book_copy = book.copy()
+    book_copy.pop('_id', None)
+    return book_copy
+
+
+def json_response(data, status=200, **kwargs):
+    return web.json_response(data, status=status, dumps=partial(json.dumps, default=encode_book), **kwargs)
+
+
+def bad_request(message):
+    return web.HTTPBadRequest(text=json.dumps({"error": message}), content_type="application/json")
+
+
+def conflict(message):
+    return web.HTTPConflict(text=json.dumps({"error": message}), content_type="application/json")
+
+
+def int_param(request, name, default, minimum, maximum):
+    value = request.query.get(name, default)
+    try:
+        value = int(value)
+    except ValueError:
+        raise bad_request(f"{name} must be a whole number") from None
+    if not minimum <= value <= maximum:
+        raise bad_request(f"{name} must be between {minimum} and {maximum}")
+    return value
+
+
+def choice_param(request, name, choices, default):
+    value = request.query.get(name, default)
+    if value not in choices:
+        raise bad_request(f"{name} must be one of: {', '.join(choices)}")
+    return value
+
+
+class LibraryApi:
+    """The request handlers, over one backend and the catalog that mirrors it.
+
+    The catalog supplies the version for ETags. Writes made here bump it
+    directly; writes made by other processes reach it through the feed.
+    Without a running feed there is no reliable version, so responses are
+    sent uncached.
+    """
+
+    def __init__(self, backend, catalog, feed=None, token=None, workers=API_WORKERS):
+        self.backend = backend
+        self.catalog = catalog
+        self.feed = feed
+        self.token = token
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="library-api")
+        self.telemetry = Telemetry()
+        # Versions restart at 0 with the process, so ETags carry the run as well.
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def etag(self):
+        if self.feed is None or not self.feed.following:
+            return None
+        return f'"{self.run_id}-{self.catalog.version}"'
+
+    def bump_version(self):
+        with self.catalog.lock:
+            self.catalog.version += 1
+
+    async def call(self, method, *args):
+        def profiled():
+            backend = self.backend
+            with self.telemetry.measure(method, "query", backend.name, args, lambda: backend.explain(method, args)) as record:
+                result = getattr(backend, method)(*args)
+                record(result)
+            return result
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool, profiled)
+        except DuplicateBookError as e:
+            raise conflict(str(e)) from None
+        except Exception as e:
+            raise web.HTTPServiceUnavailable(
+                text=json.dumps({"error": f"{self.backend.name} failed: {e}"}), content_type="application/json"
+            ) from None
+
+    @web.middleware
+    async def conditional(self, request, handler):
+        if request.method != "GET" or request.path == "/metrics":
+            return await handler(request)
+        # Taken before the handler reads, so a change during the read only
+        # makes the next request fetch again.
+        etag = self.etag()
+        if etag is not None and etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+        response = await handler(request)
+        if etag is not None and response.status == 200:
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = "no-cache"
+        else:
+            response.headers["Cache-Control"] = "no-store"
+        return response
+
+    @web.middleware
+    async def compress(self, request, handler):
+        response = await handler(request)
+        body = getattr(response, "body", None)
+        if body is not None and len(body) >= GZIP_MIN_BYTES and "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.enable_compression(web.ContentCoding.gzip)
+        return response
+
+    @web.middleware
+    async def authorize(self, request, handler):
+        if self.token and request.method not in ("GET", "HEAD"):
+            supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+            if not hmac.compare_digest(supplied, self.token):
+                return json_response({"error": "a valid bearer token is required"}, status=401)
+        return await handler(request)
+
+    async def list_books(self, request):
+        status = choice_param(request, "status", FILTER_STATUSES, "All")
+        genre = request.query.get("genre", "All")
+        sort_by = choice_param(request, "sort", list(SORT_OPTIONS), next(iter(SORT_OPTIONS)))
+        page = int_param(request, "page", 1, 1, sys.maxsize // MAX_PAGE_SIZE)
+        page_size = int_param(request, "page_size", 25, 1, MAX_PAGE_SIZE)
+        total, books = await asyncio.gather(
+            self.call("count", status, genre),
+            self.call("page", status, genre, sort_by, page, page_size),
+        )
+        return json_response({
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "pages": max(1, -(-total // page_size)),
+            "books": [public_book(book) for book in books],
+        })
+
+    async def search_books(self, request):
+        term = request.query.get("q", "").strip().lower()
+        if not term:
+            raise bad_request("q is required")
+        search_by = choice_param(request, "by", SEARCH_BY, "all")
+        limit = int_param(request, "limit", SEARCH_LIMIT, 1, SEARCH_LIMIT)
+        books = await self.call("search", term, search_by, limit)
+        return json_response({"books": [public_book(book) for book in books]})
+
+    async def genres(self, request):
+        return json_response({"genres": await self.call("genres")})
+
+    async def statistics(self, request):
+        stats = await self.call("statistics")
+        # JSON object keys are strings; authors stay [name, count] pairs.
+        return json_response({**stats, "decades": {str(decade): count for decade, count in stats["decades"].items()}})
+
+    async def metrics(self, request):
+        return web.Response(text=self.telemetry.prometheus(), content_type="text/plain")
+
+    async def add_book(self, request):
+        try:
+            fields = await request.json()
+        except ValueError:
+            raise bad_request("the body must be a JSON object") from None
+        if not isinstance(fields, dict):
+            raise bad_request("the body must be a JSON object")
+        try:
+            year = validate_book(fields.get("title"), fields.get("author"), fields.get("year"))
+        except ValueError as e:
+            raise bad_request(str(e)) from None
+        book = BookRecord(new_book(
+            str(fields["title"]), str(fields["author"]), year, str(fields.get("genre") or "Other"), bool(fields.get("read", False))
+        ))
+        # The catalog's key set answers without a backend round trip; the
+        # backend's unique index still catches a concurrent add.
+        if self.catalog.duplicate_of(book) is not None:
+            raise conflict(duplicate_message(book))
+        await self.call("insert", book)
+        if self.backend is not self.catalog:
+            self.catalog.remember(book)
+        self.bump_version()
+        return json_response(public_book(book), status=201, headers={"Location": f"/books/{book['id']}"})
+
+    async def toggle_book(self, request):
+        book_id = request.match_info["book_id"]
+        read = await self.call("toggle", book_id)
+        if read is None:
+            raise web.HTTPNotFound(text=json.dumps({"error": "no such book"}), content_type="application/json")
+        if self.backend is not self.catalog:
+            self.catalog.mark_read(book_id, read)
+        self.bump_version()
+        return json_response({"id": book_id, "read": read})
+
+    async def remove_book(self, request):
+        book_id = request.match_info["book_id"]
+        if not await self.call("delete", book_id):
+            raise web.HTTPNotFound(text=json.dumps({"error": "no such book"}), content_type="application/json")
+        if self.backend is not self.catalog:
+            self.catalog.forget(book_id)
+        self.bump_version()
+        return web.Response(status=204)
+
+    def app(self):
+        app = web.Application(middlewares=[self.compress, self.authorize, self.conditional])
+        app.add_routes([
+            web.get("/books", self.list_books),
+            web.get("/books/search", self.search_books),
+            web.get("/genres", self.genres),
+            web.get("/stats", self.statistics),
+            web.get("/metrics", self.metrics),
+            web.post("/books", self.add_book),
+            web.post("/books/{book_id}/toggle", self.toggle_book),
+            web.delete("/books/{book_id}", self.remove_book),
+        ])
+
+        async def shutdown(app):
+            if self.feed is not None:
+                self.feed.stop()
+            self.pool.shutdown(wait=False)
+
+        app.on_cleanup.append(shutdown)
+        return app
+
+
+def open_storage(args):
+    """Opens the backend named by args with a catalog that mirrors it and
+    the change feed that keeps the catalog current."""
+    if args.backend == "json":
+        catalog = JsonBackend(args.library_file, args.journal_file)
+        return catalog, catalog, start_change_feed(catalog, catalog)
+    since = None
+    if args.backend == "sqlite":
+        backend = SqliteBackend(args.sqlite)
+        since = backend.last_change()
+    else:
+        if not args.mongo_uri:
+            raise SystemExit("the mongodb backend needs --mongo-uri (or $DATABASE)")
+        from pymongo import MongoClient
+        backend = MongoBackend(MongoClient(args.mongo_uri)["personal_library"]["books"])
+        backend.prepare()
+    # Requests go to the backend; the catalog is filled by the feed.
+    catalog = JsonBackend(args.library_file, args.journal_file, [])
+    return backend, catalog, start_change_feed(backend, catalog, since, backend.load)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the library as a JSON HTTP API.")
+    parser.add_argument("--backend", choices=["mongodb", "sqlite", "json"], default=os.environ.get("STORAGE_BACKEND", "mongodb"))
+    parser.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB connection string (default: $DATABASE)")
+    parser.add_argument("--sqlite", default="library.db", help="SQLite library database")
+    parser.add_argument("--library-file", default="library.json")
+    parser.add_argument("--journal-file", default="library.journal")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="threads for backend calls")
+    parser.add_argument("--token", default=os.environ.get("LIBRARY_API_TOKEN"),
+                        help="bearer token required for writes (default: $LIBRARY_API_TOKEN; none means open)")
+    parser.add_argument("--access-log", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    backend, catalog, feed = open_storage(args)
+    for warning in backend.warnings:
+        print(warning, file=sys.stderr)
+    api = LibraryApi(backend, catalog, feed, args.token, args.workers)
+    web.run_app(api.app(), host=args.host, port=args.port, access_log=web.access_logger if args.access_log else None)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
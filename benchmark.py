@@ -0,0 +1,500 @@
+"""Benchmarks and a load driver for the library's storage backends.
+
+Synthetic libraries of any size are generated from a fixed seed, and every
+data path the app uses (load, save, search, filtered pages, counts,
+statistics, read-status toggles, recommendations) is timed against each
+backend. The http command drives the JSON API (api.py) with concurrent
+clients and reports its requests per second. Results are written as JSON
+so two commits can be compared.
+
+    python benchmark.py run --sizes 1000,100000 --backends json,sqlite -o before.json
+    python benchmark.py run --backends mongodb --mongo-uri mongodb://localhost:27017
+    python benchmark.py run --backends mongodb --mongo-uri mongomock://
+    python benchmark.py load --backend sqlite --books 100000 --users 25 --duration 30
+    python benchmark.py http --backend sqlite --books 100000 --concurrency 200 --conditional
+    python benchmark.py http --url http://127.0.0.1:8080 --duration 30
+    python benchmark.py compare before.json after.json --tolerance 1.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+from books import GENRES, SORT_OPTIONS, BookIdGenerator
+from storage import JsonBackend, MongoBackend, SqliteBackend
+
+
+BENCHMARK_BACKENDS = ["json", "sqlite", "mongodb"]
+BENCHMARK_SIZES = [1000, 10000, 100000]
+BENCHMARK_DB = "personal_library_benchmark"
+INSERT_BATCH_SIZE = 5000
+PAGE_SIZE = 25
+
+WORDS = ["shadow", "river", "empire", "garden", "winter", "stone", "silent", "glass", "dragon", "ocean",
+         "memory", "crown", "forest", "city", "night", "letters", "journey", "fire", "kingdom", "house",
+         "secret", "light", "storm", "island", "machine", "song", "wolf", "mountain", "bridge", "star"]
+FIRST_NAMES = ["Ada", "James", "Maria", "Chen", "Amara", "Lucas", "Noor", "Elena", "Kofi", "Yuki",
+               "Omar", "Sofia", "Ivan", "Priya", "Tomas", "Lena"]
+LAST_NAMES = ["Herbert", "Austen", "Okafor", "Tanaka", "Silva", "Novak", "Haddad", "Lindqvist", "Mensah",
+              "Kowalski", "Reyes", "Sato", "Moreau", "Ibrahim", "Park", "Fischer"]
+
+SEARCHES = [("dragon", "all"), ("sil", "all"), ("winter river", "all"), ("herbert", "author"),
+            ("glass", "title"), ("mystery", "genre"), ("1984", "year")]
+HTTP_SERVER_START_SECONDS = 30
+VIEWS = [("All", "All", "Title (A-Z)", 1), ("Read", "All", "Year (Newest)", 1),
+         ("Unread", "Fantasy", "Author (A-Z)", 1), ("All", "All", "Added", 1), ("All", "All", "Title (A-Z)", 40)]
+
+
+def generate_books(count, seed=0):
+    """Yields count books with a realistic spread of titles, authors, genres and years."""
+    rng = random.Random(seed)
+    ids = BookIdGenerator()
+    authors = [f"{first} {last}" for first in FIRST_NAMES for last in LAST_NAMES]
+    start = datetime(2020, 1, 1)
+    for position in range(count):
+        added = start + timedelta(minutes=position)
+        title_words = rng.sample(WORDS, rng.randint(1, 4))
+        yield {
+            "id": ids.next_id(added.timestamp() * 1000),
+            "title": " ".join(title_words).title(),
+            "author": rng.choice(authors),
+            "year": rng.randint(1800, 2025),
+            "genre": rng.choice(GENRES),
+            "read": rng.random() < 0.4,
+            "date_added": added.strftime("%Y-%m-%d"),
+        }
+
+
+def open_backend(name, books, workdir, mongo_uri=None):
+    """Creates a backend holding books. Returns (backend, cleanup)."""
+    if name == "json":
+        library_file = os.path.join(workdir, "library.json")
+        journal_file = os.path.join(workdir, "library.journal")
+        JsonBackend(library_file, journal_file, []).write_snapshot(books)
+        return JsonBackend(library_file, journal_file), lambda: None
+    if name == "sqlite":
+        backend = SqliteBackend(os.path.join(workdir, "library.db"))
+        for start in range(0, len(books), INSERT_BATCH_SIZE):
+            backend.insert_many(books[start:start + INSERT_BATCH_SIZE])
+        return backend, lambda: None
+    if not mongo_uri:
+        raise ValueError("the mongodb backend needs --mongo-uri (or $DATABASE)")
+    if mongo_uri.startswith("mongomock://"):
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+    collection = client[BENCHMARK_DB][f"books_{len(books)}_{os.getpid()}"]
+    collection.drop()
+    for start in range(0, len(books), INSERT_BATCH_SIZE):
+        collection.insert_many([dict(book) for book in books[start:start + INSERT_BATCH_SIZE]], ordered=False)
+    backend = MongoBackend(collection)
+    backend.prepare()
+    backend.load()
+    return backend, collection.drop
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, elapsed):
+    return {
+        "runs": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def time_operation(operation, repeat):
+    """Times repeat calls of operation, then one more under tracemalloc for the peak memory."""
+    latencies = []
+    started = time.perf_counter()
+    for run in range(repeat):
+        before = time.perf_counter()
+        operation(run)
+        latencies.append(time.perf_counter() - before)
+    result = summarize(latencies, time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        operation(repeat)
+        result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def backend_operations(backend, books, rng):
+    ids = [book["id"] for book in books]
+
+    def save(run):
+        # Change about 1% of the books, so diffing backends have something to send.
+        library = backend.load()
+        for book in rng.sample(library, max(1, len(library) // 100)):
+            book["read"] = not book.get("read", False)
+        backend.save(library)
+
+    operations = {
+        "load": lambda run: backend.load(),
+        "save": save,
+        "search": lambda run: backend.search(*SEARCHES[run % len(SEARCHES)]),
+        "page": lambda run: backend.page(*VIEWS[run % len(VIEWS)][:3], VIEWS[run % len(VIEWS)][3], PAGE_SIZE),
+        "count": lambda run: backend.count(*VIEWS[run % len(VIEWS)][:2]),
+        "statistics": lambda run: backend.statistics(),
+        "toggle": lambda run: backend.toggle(rng.choice(ids)),
+    }
+    if isinstance(backend, JsonBackend):
+        # Recommendations come from the in-memory catalog only; alternate
+        # similar-to-one-book and reader queries. The matrix is built here
+        # so the timings are of queries, not of the first build.
+        backend.similar()
+
+        def similar(run):
+            return backend.similar([rng.choice(ids)] if run % 2 else None)
+
+        operations["similar"] = similar
+    return operations
+
+
+def git_commit():
+    # The checkout this file is in, wherever the benchmark is run from.
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(args):
+    bulk_repeat = max(1, args.repeat // 10)
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "seed": args.seed,
+        "results": [],
+    }
+    for size in args.sizes:
+        books = list(generate_books(size, args.seed))
+        for name in args.backends:
+            workdir = tempfile.mkdtemp(prefix="library-benchmark-")
+            try:
+                setup_started = time.perf_counter()
+                backend, cleanup = open_backend(name, books, workdir, args.mongo_uri)
+                print(f"{name} {size}: set up in {time.perf_counter() - setup_started:.1f}s", file=sys.stderr)
+                try:
+                    rng = random.Random(args.seed)
+                    for operation, call in backend_operations(backend, books, rng).items():
+                        if args.operations and operation not in args.operations:
+                            continue
+                        repeat = bulk_repeat if operation in ("load", "save") else args.repeat
+                        row = {"backend": name, "books": size, "operation": operation}
+                        try:
+                            row.update(time_operation(call, repeat))
+                        except Exception as e:
+                            # e.g. an operation a stand-in like mongomock does not support
+                            row["error"] = str(e)
+                            print(f"  {operation:<10} failed: {e}", file=sys.stderr)
+                        else:
+                            print(f"  {operation:<10} p50 {row['p50_ms']:>10.3f} ms  p99 {row['p99_ms']:>10.3f} ms",
+                                  file=sys.stderr)
+                        report["results"].append(row)
+                finally:
+                    cleanup()
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def simulate_session(backend, rng, think_time, stop, latencies, errors, lock):
+    # One user: every rerun reads what the Library tab shows; some reruns
+    # also type a search or toggle a book, as a real session would.
+    genres = ["All"] + GENRES
+    book_ids = [book["id"] for book in backend.page("All", "All", "Added", 1, PAGE_SIZE * 4)]
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            status = rng.choice(["All", "Read", "Unread"])
+            genre = rng.choice(genres)
+            sort_by = rng.choice(list(SORT_OPTIONS))
+            backend.count(status, genre)
+            backend.page(status, genre, sort_by, rng.randint(1, 4), PAGE_SIZE)
+            if rng.random() < 0.2:
+                backend.statistics()
+            if rng.random() < 0.3:
+                term, search_by = rng.choice(SEARCHES)
+                for cut in range(2, len(term) + 1, 2):
+                    backend.search(term[:cut], search_by)
+            if book_ids and rng.random() < 0.05:
+                backend.toggle(rng.choice(book_ids))
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+        else:
+            with lock:
+                latencies.append(time.perf_counter() - started)
+        if think_time:
+            stop.wait(rng.expovariate(1 / think_time))
+
+
+def run_load(args):
+    workdir = tempfile.mkdtemp(prefix="library-load-")
+    try:
+        books = list(generate_books(args.books, args.seed))
+        backend, cleanup = open_backend(args.backend, books, workdir, args.mongo_uri)
+        try:
+            latencies, errors = [], []
+            lock = threading.Lock()
+            stop = threading.Event()
+            sessions = [
+                threading.Thread(
+                    target=simulate_session,
+                    args=(backend, random.Random(args.seed + user), args.think_ms / 1000, stop, latencies, errors, lock),
+                    daemon=True,
+                )
+                for user in range(args.users)
+            ]
+            started = time.perf_counter()
+            for session in sessions:
+                session.start()
+            time.sleep(args.duration)
+            stop.set()
+            for session in sessions:
+                session.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            cleanup()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result = {
+        "commit": git_commit(),
+        "backend": args.backend,
+        "books": args.books,
+        "users": args.users,
+        "think_ms": args.think_ms,
+        "duration_s": round(elapsed, 2),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+    }
+    if latencies:
+        summary = summarize(latencies, elapsed)
+        summary["reruns_per_sec"] = summary.pop("ops_per_sec")
+        result.update(summary)
+    return result
+
+
+def http_paths():
+    # The same mix of views and searches the other benchmarks use.
+    paths = [
+        f"/books?status={status}&genre={quote(genre)}&sort={quote(sort_by)}&page={page}&page_size={PAGE_SIZE}"
+        for status, genre, sort_by, page in VIEWS
+    ]
+    paths += [f"/books/search?q={quote(term)}&by={search_by}" for term, search_by in SEARCHES]
+    return paths + ["/genres", "/stats"]
+
+
+async def drive_http(url, paths, concurrency, duration, conditional, seed):
+    import aiohttp
+
+    latencies, errors = [], []
+    statuses = Counter()
+    etags = {}
+    deadline = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, headers={"Accept-Encoding": "gzip"}) as session:
+        async def client(rng):
+            while time.perf_counter() < deadline:
+                path = rng.choice(paths)
+                headers = {"If-None-Match": etags[path]} if conditional and path in etags else {}
+                started = time.perf_counter()
+                try:
+                    async with session.get(url + path, headers=headers) as response:
+                        await response.read()
+                        if "ETag" in response.headers:
+                            etags[path] = response.headers["ETag"]
+                        statuses[response.status] += 1
+                except Exception as e:
+                    errors.append(str(e))
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client(random.Random(seed + position)) for position in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, statuses, errors, elapsed
+
+
+def start_api_server(backend_name, workdir):
+    """Runs api.py over the library in workdir on a free port. Returns (process, url)."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "api.py"), "--backend", backend_name,
+         "--port", str(port), "--sqlite", "library.db", "--library-file", "library.json", "--journal-file", "library.journal"],
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + HTTP_SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, url
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("the API server did not start")
+
+
+def run_http(args):
+    workdir = process = None
+    url = args.url
+    try:
+        if url is None:
+            workdir = tempfile.mkdtemp(prefix="library-http-")
+            open_backend(args.backend, list(generate_books(args.books, args.seed)), workdir)
+            process, url = start_api_server(args.backend, workdir)
+        latencies, statuses, errors, elapsed = asyncio.run(
+            drive_http(url.rstrip("/"), http_paths(), args.concurrency, args.duration, args.conditional, args.seed)
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    result = {
+        "commit": git_commit(),
+        "url": args.url,
+        "backend": None if args.url else args.backend,
+        "books": None if args.url else args.books,
+        "concurrency": args.concurrency,
+        "conditional": args.conditional,
+        "duration_s": round(elapsed, 2),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "errors": len(errors),
+        "error_samples": errors[:5],
+    }
+    if latencies:
+        summary = summarize(latencies, elapsed)
+        summary["requests_per_sec"] = summary.pop("ops_per_sec")
+        result.update(summary)
+    return result
+
+
+def compare_reports(old, new, tolerance):
+    """Returns the rows of new whose p50 is more than tolerance times the old one."""
+    baseline = {(row["backend"], row["books"], row["operation"]): row for row in old["results"]}
+    regressions = []
+    for row in new["results"]:
+        before = baseline.get((row["backend"], row["books"], row["operation"]))
+        if before is None or not before.get("p50_ms") or "p50_ms" not in row:
+            continue
+        ratio = row["p50_ms"] / before["p50_ms"]
+        print(f"{row['backend']:<8} {row['books']:>8} {row['operation']:<10} "
+              f"{before['p50_ms']:>10.3f} -> {row['p50_ms']:>10.3f} ms  x{ratio:.2f}")
+        if ratio > tolerance:
+            regressions.append({**row, "baseline_p50_ms": before["p50_ms"], "ratio": round(ratio, 2)})
+    return regressions
+
+
+def comma_list(convert=str):
+    return lambda value: [convert(item) for item in value.split(",") if item]
+
+
+def write_report(report, output):
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark and load-test the library's storage backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="time every data path on synthetic libraries")
+    run.add_argument("--sizes", type=comma_list(int), default=BENCHMARK_SIZES, help="library sizes, e.g. 1000,1000000")
+    run.add_argument("--backends", type=comma_list(), default=["json", "sqlite"], help="any of: " + ", ".join(BENCHMARK_BACKENDS))
+    run.add_argument("--operations", type=comma_list(), help="only these operations (default: all)")
+    run.add_argument("--repeat", type=int, default=50, help="runs per query; load and save run a tenth as often")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB to use, or mongomock:// (default: $DATABASE)")
+    run.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+
+    load = commands.add_parser("load", help="simulate concurrent users against one backend")
+    load.add_argument("--backend", choices=BENCHMARK_BACKENDS, default="json")
+    load.add_argument("--books", type=int, default=10000)
+    load.add_argument("--users", type=int, default=10)
+    load.add_argument("--duration", type=float, default=10, help="seconds to run")
+    load.add_argument("--think-ms", type=float, default=0, help="mean pause between a user's reruns")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB to use, or mongomock:// (default: $DATABASE)")
+    load.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+
+    http = commands.add_parser("http", help="load-test the JSON API and report requests per second")
+    http.add_argument("--url", help="a running API server (default: start one over a synthetic library)")
+    http.add_argument("--backend", choices=["json", "sqlite"], default="sqlite", help="backend of the server started here")
+    http.add_argument("--books", type=int, default=10000)
+    http.add_argument("--concurrency", type=int, default=100, help="requests in flight")
+    http.add_argument("--duration", type=float, default=10, help="seconds to run")
+    http.add_argument("--conditional", action="store_true", help="revalidate with If-None-Match, as caching clients do")
+    http.add_argument("--seed", type=int, default=0)
+    http.add_argument("-o", "--output", help="write the JSON report here instead of stdout")
+
+    compare = commands.add_parser("compare", help="compare two run reports and fail on slowdowns")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--tolerance", type=float, default=1.2, help="allowed p50 ratio before failing")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        unknown = set(args.backends) - set(BENCHMARK_BACKENDS)
+        if unknown:
+            parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+        write_report(run_benchmarks(args), args.output)
+    elif args.command == "load":
+        write_report(run_load(args), args.output)
+    elif args.command == "http":
+        write_report(run_http(args), args.output)
+    else:
+        with open(args.baseline) as file:
+            old = json.load(file)
+        with open(args.current) as file:
+            new = json.load(file)
+        regressions = compare_reports(old, new, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} operations are more than {args.tolerance}x slower", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
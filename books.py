@@ -0,0 +1,258 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from datetime import datetime
+
+
+SORT_OPTIONS = {
+    "Title (A-Z)": ("title", 1, ""),
+    "Author (A-Z)": ("author", 1, ""),
+    "Year (Newest)": ("year", -1, 0),
+    "Added": ("id", -1, ""),
+}
+
+
+def sort_value(value):
+    # Ranks the type first, as MongoDB does (null, numbers, strings, the
+    # rest), so a None year or a year stored as text never gets compared
+    # with a number.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+GENRES = ["Fiction", "Non-Fiction", "Mystery", "Sci-Fi", "Fantasy", "Biography", "History", "Self-Help",
+          "Romance", "Horror", "Thriller", "Poetry", "Science", "Technology", "Philosophy", "Other"]
+
+LOAD_CHUNK_SIZE = 1 << 16
+
+BOOK_ID_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+BOOK_ID_PATTERN = re.compile(r"^[0-9A-HJKMNP-TV-Z]{26}$")
+MIGRATION_BATCH_SIZE = 1000
+KEY_PUNCTUATION = re.compile(r"[\W_]+")
+
+
+def validate_book(title, author, year):
+    if not title or not author:
+        raise ValueError("Title and author are required.")
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        raise ValueError("Year must be a valid Number.") from None
+    if not (0 <= year <= datetime.now().year):
+        raise ValueError(f"Year must be between 0 and {datetime.now().year}.")
+    return year
+
+
+def normalize_text(text):
+    # Case-folded, accents and punctuation stripped, single spaces.
+    text = unicodedata.normalize("NFKD", str(text or "")).casefold()
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return KEY_PUNCTUATION.sub(" ", text).strip()
+
+
+def book_key(title, author):
+    """The title/author pair that identifies a book; two books with the same
+    key are duplicates."""
+    return f"{normalize_text(title)}|{normalize_text(author)}"
+
+
+class BookIdGenerator:
+    """ULID-style book ids: a 48-bit millisecond timestamp followed by 80 random
+    bits, in Crockford base32.
+
+    Ids sort in creation order. Within one millisecond (or for timestamps
+    older than the last one) the random part is incremented instead, so ids
+    from one generator are strictly increasing.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_time = -1
+        self.last_random = 0
+
+    def next_id(self, timestamp_ms=None):
+        with self.lock:
+            now = int(time.time() * 1000) if timestamp_ms is None else int(timestamp_ms)
+            if now > self.last_time:
+                self.last_time = now
+                self.last_random = random.SystemRandom().getrandbits(80)
+            else:
+                self.last_random += 1
+                if self.last_random >> 80:
+                    self.last_time += 1
+                    self.last_random = 0
+            value = (self.last_time << 80) | self.last_random
+        chars = []
+        for _ in range(26):
+            chars.append(BOOK_ID_ALPHABET[value & 31])
+            value >>= 5
+        return "".join(reversed(chars))
+
+
+BOOK_IDS = BookIdGenerator()
+
+
+def new_book_id():
+    return BOOK_IDS.next_id()
+
+
+def is_book_id(value):
+    return isinstance(value, str) and BOOK_ID_PATTERN.match(value) is not None
+
+
+def date_added_ms(book):
+    try:
+        return datetime.strptime(str(book.get("date_added")), "%Y-%m-%d").timestamp() * 1000
+    except ValueError:
+        return None
+
+
+def migrate_mongo_book_ids(collection, batch_size=MIGRATION_BATCH_SIZE):
+    """Gives every document without a well-formed id a new one, in bulk.
+
+    Documents are visited in _id order and stamped with their ObjectId's
+    creation time, so the new ids keep the original insertion order.
+    Returns the number of documents updated.
+    """
+    from pymongo import UpdateOne
+
+    generator = BookIdGenerator()
+    cursor = collection.find({"id": {"$not": BOOK_ID_PATTERN}}, {"_id": 1}).sort("_id", 1).batch_size(batch_size)
+    operations = []
+    migrated = 0
+    for doc in cursor:
+        created = getattr(doc["_id"], "generation_time", None)
+        book_id = generator.next_id(created.timestamp() * 1000 if created else None)
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"id": book_id}}))
+        if len(operations) >= batch_size:
+            migrated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        migrated += collection.bulk_write(operations, ordered=False).modified_count
+    return migrated
+
+
+def new_book(title, author, year, genre, read_status, date_added=None):
+    return {
+        "id": new_book_id(),
+        "title": title,
+        "author": author,
+        "year": year,
+        "genre": genre,
+        "read": read_status,
+        "date_added": date_added or datetime.now().strftime("%Y-%m-%d"),
+        "key": book_key(title, author),
+    }
+
+
+def build_filter_query(filter_status, filter_genre):
+    query = {}
+    if filter_status == "Read":
+        query["read"] = True
+    elif filter_status == "Unread":
+        query["read"] = False
+    if filter_genre != "All":
+        query["genre"] = filter_genre
+    return query
+
+
+def build_sort_spec(sort_by):
+    field, direction, _ = SORT_OPTIONS[sort_by]
+    if field == "id":
+        return [(field, direction)]
+    # _id breaks ties so that pages do not overlap when the sort key repeats
+    return [(field, direction), ("_id", direction)]
+
+
+def iter_json_records(path, chunk_size=LOAD_CHUNK_SIZE):
+    with open(path, "r") as file:
+        yield from iter_json_file(file, chunk_size)
+
+
+def iter_json_file(file, chunk_size=LOAD_CHUNK_SIZE):
+    # Yields the objects of a JSON array or JSON Lines text file one at a
+    # time, so the whole file is never held in memory as text.
+    decoder = json.JSONDecoder()
+    buffer = file.read(chunk_size)
+    position = 0
+    eof = not buffer
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+            position += 1
+        if position >= len(buffer):
+            if eof:
+                return
+            buffer = file.read(chunk_size)
+            position = 0
+            eof = not buffer
+            continue
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            more = file.read(chunk_size)
+            eof = not more
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield record
+        position = end
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+
+def iter_stored_books(library_file, journal_file):
+    # Streams the books of a snapshot with its journal applied. Only the
+    # journal's changes are held in memory, never the whole snapshot.
+    changes = {}
+    if os.path.exists(journal_file):
+        with open(journal_file, "r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry["op"] == "add":
+                    changes[entry["book"]["id"]] = ("put", dict(entry["book"]))
+                elif entry["op"] == "remove":
+                    changes[entry["id"]] = ("remove", None)
+                elif entry["op"] == "update":
+                    kind, fields = changes.get(entry["id"], ("update", {}))
+                    if kind != "remove":
+                        fields.update(entry["fields"])
+                        changes[entry["id"]] = (kind, fields)
+
+    if os.path.exists(library_file):
+        for book in iter_json_records(library_file):
+            kind, fields = changes.pop(book.get("id"), (None, None))
+            if kind == "remove":
+                continue
+            if kind == "put":
+                book = fields
+            elif kind == "update":
+                book.update(fields)
+            book.setdefault("read", False)
+            yield book
+    for kind, book in changes.values():
+        if kind == "put":
+            book.setdefault("read", False)
+            yield book
+
+
+def matches_filter(book, filter_status, filter_genre):
+    if filter_status == "Read" and not book.get("read", False):
+        return False
+    if filter_status == "Unread" and book.get("read", False):
+        return False
+    return filter_genre == "All" or book.get("genre", "Other") == filter_genre
@@ -0,0 +1,235 @@
+"""Bulk import of books from CSV, JSON, JSON Lines or Excel files.
+
+Rows are streamed from the source, validated with the same rules as the
+"+ Add Book" form and written in batches. Rows that cannot be parsed or
+fail validation, and rows that repeat a title and author already in the
+library or earlier in the file, are collected as rejects instead of
+aborting the run. A .json file is read like library.json: one array of
+objects (or JSON Lines).
+
+    python bulk_import.py catalog.csv --mongo-uri "$DATABASE"
+    python bulk_import.py catalog.xlsx --journal library.journal
+    python bulk_import.py catalog.jsonl --sqlite library.db
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+
+from books import iter_json_file, new_book, validate_book
+
+
+IMPORT_FORMATS = ["csv", "json", "jsonl", "xlsx"]
+IMPORT_BATCH_SIZE = 1000
+READ_VALUES = {"true", "yes", "y", "1", "read"}
+DUPLICATE_ROW = "A book with this title and author is already in the library."
+
+
+class RowParseError(ValueError):
+    """A record of the source that could not be read as a row; iter_rows
+    yields it in the row's place, so it becomes a reject."""
+
+    def __init__(self, message, text):
+        super().__init__(message)
+        self.row = {"raw": text}
+
+
+def detect_format(name):
+    extension = os.path.splitext(name)[1].lower().lstrip(".")
+    if extension not in IMPORT_FORMATS:
+        raise ValueError(f"Unsupported file type '{extension}'. Use one of: {', '.join(IMPORT_FORMATS)}.")
+    return extension
+
+
+def object_row(record, text):
+    if not isinstance(record, dict):
+        return RowParseError(f"Expected a JSON object, got {type(record).__name__}.", text)
+    return {str(key).strip().lower(): value for key, value in record.items()}
+
+
+def iter_rows(source, file_format):
+    # source is a path or a binary file object (e.g. a Streamlit upload).
+    if file_format == "xlsx":
+        from openpyxl import load_workbook
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(cell).strip().lower() if cell is not None else "" for cell in next(rows, [])]
+            for values in rows:
+                if any(value is not None for value in values):
+                    yield dict(zip(header, values))
+        finally:
+            workbook.close()
+        return
+
+    if isinstance(source, (str, os.PathLike)):
+        text = open(source, "r", encoding="utf-8-sig", newline="")
+    else:
+        text = io.TextIOWrapper(source, encoding="utf-8-sig", newline="")
+    with text:
+        if file_format == "csv":
+            for row in csv.DictReader(text):
+                yield {str(key).strip().lower(): value for key, value in row.items() if key is not None}
+        elif file_format == "json":
+            try:
+                for record in iter_json_file(text):
+                    yield object_row(record, json.dumps(record))
+            except json.JSONDecodeError as e:
+                # Past a syntax error there is no telling where the next record starts.
+                yield RowParseError(f"Invalid JSON ({e}); the rest of the file was not read.", "")
+        else:
+            for line in text:
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        yield RowParseError(f"Invalid JSON: {e}", line.strip())
+                        continue
+                    yield object_row(record, line.strip())
+
+
+def row_to_book(row):
+    title = str(row.get("title") or "").strip()
+    author = str(row.get("author") or "").strip()
+    year = row.get("year")
+    if isinstance(year, float) and year.is_integer():
+        year = int(year)
+    year = validate_book(title, author, year)
+    genre = str(row.get("genre") or "").strip() or "Other"
+    read = row.get("read", False)
+    if not isinstance(read, bool):
+        read = str(read).strip().lower() in READ_VALUES
+    date_added = row.get("date_added")
+    return new_book(title, author, year, genre, read, str(date_added) if date_added else None)
+
+
+def import_books(rows, write_batch, batch_size=IMPORT_BATCH_SIZE, progress=None, is_duplicate=None):
+    """Validates rows and passes them to write_batch in lists of batch_size.
+
+    Returns (imported, rejects) where rejects is a list of (line, row, error).
+    progress, if given, is called with (imported, rejected) after every batch.
+    is_duplicate, if given, tells whether a book is already in the library.
+    write_batch may return the books the store refused as duplicates; their
+    rows become rejects.
+    """
+    imported = 0
+    rejects = []
+    batch = []
+    keys = set()
+
+    def flush():
+        refused = {book["id"] for book in write_batch([book for _, _, book in batch]) or ()}
+        rejects.extend((line, row, DUPLICATE_ROW) for line, row, book in batch if book["id"] in refused)
+        return len(batch) - len(refused)
+
+    for line, row in enumerate(rows, start=1):
+        try:
+            if isinstance(row, RowParseError):
+                raise row
+            book = row_to_book(row)
+            if book["key"] in keys or (is_duplicate is not None and is_duplicate(book)):
+                raise ValueError(DUPLICATE_ROW)
+            keys.add(book["key"])
+            batch.append((line, row, book))
+        except ValueError as e:
+            rejects.append((line, row.row if isinstance(row, RowParseError) else row, str(e)))
+        if len(batch) >= batch_size:
+            imported += flush()
+            batch = []
+            if progress:
+                progress(imported, len(rejects))
+    if batch:
+        imported += flush()
+    if progress:
+        progress(imported, len(rejects))
+    return imported, rejects
+
+
+def write_rejects(rejects, file):
+    fields = []
+    for _, row, _ in rejects:
+        fields.extend(key for key in row if key not in fields)
+    writer = csv.DictWriter(file, fieldnames=["line", "error"] + fields, extrasaction="ignore")
+    writer.writeheader()
+    for line, row, error in rejects:
+        writer.writerow({**row, "line": line, "error": error})
+
+
+def backend_batch_writer(backend):
+    # The books the backend refused as duplicates, for import_books to reject.
+    from storage import DuplicateBookError
+
+    def write_batch(books):
+        try:
+            backend.insert_many(books)
+        except DuplicateBookError as e:
+            return e.books
+        return []
+    return write_batch
+
+
+def journal_batch_writer(journal_file):
+    # Same line format the app appends in file mode; the app replays it on load.
+    # Under the app's journal lock, so a compaction never truncates a batch away.
+    from storage import FileLock, append_changes
+
+    lock = FileLock(f"{journal_file}.lock")
+
+    def write_batch(books):
+        with lock:
+            append_changes(journal_file, [{"op": "add", "book": book} for book in books])
+    return write_batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import books into the library.")
+    parser.add_argument("source", help="CSV, JSON, JSON Lines or XLSX file to import")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="file format (default: from the extension)")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB connection string (default: $DATABASE)")
+    target.add_argument("--journal", help="append to this library journal file instead of MongoDB")
+    target.add_argument("--sqlite", help="insert into this SQLite library database instead of MongoDB")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--rejects", help="where to write rejected rows (default: <source>.rejects.csv)")
+    args = parser.parse_args(argv)
+
+    file_format = args.format or detect_format(args.source)
+    if args.journal:
+        write_batch = journal_batch_writer(args.journal)
+    elif args.sqlite:
+        from storage import SqliteBackend
+        backend = SqliteBackend(args.sqlite)
+        write_batch = backend_batch_writer(backend)
+    elif args.mongo_uri:
+        from pymongo import MongoClient
+        from storage import MongoBackend
+        backend = MongoBackend(MongoClient(args.mongo_uri)["personal_library"]["books"])
+        write_batch = backend_batch_writer(backend)
+    else:
+        parser.error("either --mongo-uri (or $DATABASE) or --journal is required")
+    if args.journal:
+        # The journal alone does not say what is in the library; only repeats within the file are caught.
+        existing = set()
+    else:
+        from dedupe import iter_library
+        from storage import record_key
+        existing = {record_key(book) for book in iter_library(backend)}
+
+    def progress(imported, rejected):
+        print(f"\rimported {imported}, rejected {rejected}", end="", file=sys.stderr, flush=True)
+
+    imported, rejects = import_books(iter_rows(args.source, file_format), write_batch, args.batch_size, progress,
+                                     lambda book: book["key"] in existing)
+    print(file=sys.stderr)
+    if rejects:
+        rejects_file = args.rejects or f"{args.source}.rejects.csv"
+        with open(rejects_file, "w", newline="") as file:
+            write_rejects(rejects, file)
+        print(f"{len(rejects)} rejected rows written to {rejects_file}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""Live feeds of changes made to the primary store by other processes.
+
+Each feed runs on a background thread and pushes only the books that
+changed into the shared catalog (JsonBackend.merge_changes), which bumps
+the catalog version that every session's caches and views are keyed on:
+
+    MongoChangeFeed    a MongoDB change stream (replica sets and Atlas)
+    SqliteChangeFeed   watches the database files and reads the book_changes
+                       log kept by the SQLite triggers
+    JournalFeed        watches library.json and its journal and reads the
+                       entries appended since the last look
+
+Changes this process made itself come back through the feed too; the
+catalog already holds them, so they are skipped without a version bump.
+When a feed loses its place (an expired resume token, a pruned change log,
+a compacted journal) it re-lists the store and merges only the differences.
+
+A feed can also fill an empty catalog (preload): the books are listed on
+the feed thread once the feed holds its position, so changes made while
+they are listed are applied after them instead of being lost.
+"""
+import os
+import threading
+
+from storage import LOAD_PROJECTION, BookRecord, MongoBackend, SqliteBackend, parse_changes
+
+
+FEED_RETRY_SECONDS = 5.0
+# Quiet period after a file event, so a burst of writes is read in one go.
+WATCH_DEBOUNCE_SECONDS = 0.2
+SQLITE_CHANGE_LOG_ROWS = 10000
+
+
+class ChangeFeed:
+    """Base for the feeds: a daemon thread that runs follow() until stopped,
+    restarting it after errors. Problems are added to warnings; following
+    is true while changes are being picked up."""
+
+    name = "change feed"
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.preload = None
+        self.warnings = []
+        self.following = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.follow()
+            except Exception as e:
+                self.following = False
+                warning = f"The {self.name} failed ({e}); retrying."
+                if warning not in self.warnings:
+                    self.warnings.append(warning)
+                # Without the feed there is no position to keep, but the catalog still needs its books.
+                try:
+                    self.load_catalog()
+                except Exception:
+                    pass
+            self.stopped.wait(FEED_RETRY_SECONDS)
+
+    def load_catalog(self):
+        if self.preload is not None:
+            self.catalog.merge_library(self.preload())
+            self.preload = None
+
+    def follow(self):
+        raise NotImplementedError
+
+    def merge(self, books=(), removed=()):
+        return self.catalog.merge_changes(
+            [{"op": "add", "book": book} for book in books] + [{"op": "remove", "id": book_id} for book_id in removed]
+        )
+
+
+class MongoChangeFeed(ChangeFeed):
+    name = "MongoDB change stream"
+
+    def __init__(self, catalog, collection, start_at=None, max_await_ms=1000):
+        super().__init__(catalog)
+        self.collection = collection
+        self.max_await_ms = max_await_ms
+        self.resume_token = None
+        # The cluster time from before the catalog was loaded, so the first
+        # stream starts there rather than at the time it opens.
+        self.start_at = start_at
+        # Delete events only carry the ObjectId, so map those back to book ids.
+        with catalog.lock:
+            self.book_ids = {book['_id']: book['id'] for book in catalog.books if '_id' in book}
+
+    def follow(self):
+        from pymongo.errors import OperationFailure
+
+        try:
+            self.watch()
+        except OperationFailure as e:
+            if e.code == 40573:
+                # Standalone servers have no change streams; there is nothing to retry.
+                self.warnings.append("MongoDB change streams need a replica set; changes from other app instances show up after a reload.")
+                self.following = False
+                self.stop()
+                self.load_catalog()
+            elif e.code == 286:
+                # The oplog no longer reaches back to the resume token.
+                self.resume_token = self.start_at = None
+                self.resync()
+            else:
+                raise
+
+    def watch(self):
+        with self.collection.watch(
+            full_document="updateLookup",
+            resume_after=self.resume_token,
+            start_at_operation_time=None if self.resume_token else self.start_at,
+            max_await_time_ms=self.max_await_ms,
+        ) as stream:
+            self.load_catalog()
+            self.following = True
+            batch = []
+            while stream.alive and not self.stopped.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    batch.append(change)
+                    if len(batch) < 1000:
+                        continue
+                if batch:
+                    self.apply(batch)
+                    batch = []
+                self.resume_token = stream.resume_token
+
+    def apply(self, changes):
+        books, removed = {}, {}
+        for change in changes:
+            operation = change["operationType"]
+            if operation in ("insert", "replace", "update"):
+                document = change.get("fullDocument")
+                # None when the book was deleted before the lookup; its delete follows.
+                if document is not None and 'id' in document:
+                    document['_id'] = str(document['_id'])
+                    self.book_ids[document['_id']] = document['id']
+                    removed.pop(document['id'], None)
+                    books[document['id']] = BookRecord(document)
+            elif operation == "delete":
+                book_id = self.book_ids.pop(str(change["documentKey"]["_id"]), None)
+                if book_id is not None:
+                    books.pop(book_id, None)
+                    removed[book_id] = True
+            elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+                self.resume_token = self.start_at = None
+                self.resync()
+                return
+        self.merge(books.values(), removed)
+
+    def load_catalog(self):
+        super().load_catalog()
+        with self.catalog.lock:
+            self.book_ids.update((book['_id'], book['id']) for book in self.catalog.books if '_id' in book)
+
+    def resync(self):
+        library = []
+        for document in self.collection.find({"id": {"$exists": True}}, LOAD_PROJECTION):
+            document['_id'] = str(document['_id'])
+            self.book_ids[document['_id']] = document['id']
+            library.append(BookRecord(document))
+        self.catalog.merge_library(library)
+
+
+class FileWatchFeed(ChangeFeed):
+    """Wakes on watchdog events for the given files and calls poll()."""
+
+    def __init__(self, catalog, paths):
+        super().__init__(catalog)
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.changed = threading.Event()
+
+    def follow(self):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+
+        feed = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                touched = {os.path.abspath(event.src_path), os.path.abspath(getattr(event, "dest_path", "") or "")}
+                if touched & feed.paths:
+                    feed.changed.set()
+
+        observer = Observer()
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            observer.schedule(Handler(), directory, recursive=False)
+        observer.daemon = True
+        observer.start()
+        try:
+            self.load_catalog()
+            self.poll()
+            self.following = True
+            while not self.stopped.is_set():
+                if not self.changed.wait(1.0):
+                    continue
+                self.stopped.wait(WATCH_DEBOUNCE_SECONDS)
+                self.changed.clear()
+                self.poll()
+        finally:
+            self.following = False
+            observer.stop()
+
+    def poll(self):
+        raise NotImplementedError
+
+
+class SqliteChangeFeed(FileWatchFeed):
+    name = "SQLite change feed"
+
+    def __init__(self, catalog, backend, seq=None):
+        super().__init__(catalog, [backend.path, f"{backend.path}-wal"])
+        self.backend = backend
+        # Callers pass the position taken before the catalog was loaded, so
+        # nothing written in between is missed.
+        self.seq = backend.last_change() if seq is None else seq
+
+    def poll(self):
+        changes = self.backend.changes_since(self.seq)
+        if changes is None:
+            # Fell behind the pruned log.
+            self.seq = self.backend.last_change()
+            self.catalog.merge_library(self.backend.load())
+            return
+        self.seq, books, removed = changes
+        if books or removed:
+            self.merge([BookRecord(book) for book in books], removed)
+            self.backend.prune_changes(SQLITE_CHANGE_LOG_ROWS)
+
+
+class JournalFeed(FileWatchFeed):
+    name = "library file watcher"
+
+    def __init__(self, catalog, position=None):
+        super().__init__(catalog, [catalog.library_file, catalog.journal_file])
+        # Where the catalog's load left the files, if it loaded them itself.
+        self.snapshot_mtime, self.offset = position or catalog.loaded_position or catalog.file_position()
+
+    def poll(self):
+        with self.catalog.file_lock:
+            snapshot_mtime, size = self.catalog.file_position()
+            if snapshot_mtime != self.snapshot_mtime or size < self.offset:
+                # The journal was folded into a new snapshot.
+                self.snapshot_mtime = snapshot_mtime
+                self.offset = size
+                library = self.catalog.replay_journal(self.catalog.read_snapshot())
+            else:
+                library = None
+                entries = []
+                if size > self.offset:
+                    entries, self.offset = self.read_journal(self.offset)
+        if library is not None:
+            self.catalog.merge_library(library)
+        elif entries:
+            self.catalog.merge_changes(entries)
+
+    def read_journal(self, offset):
+        # Only whole lines; a line still being written is read on the next event.
+        with open(self.catalog.journal_file, "rb") as file:
+            file.seek(offset)
+            data = file.read()
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return [], offset
+        return parse_changes(data[:end].decode("utf-8").splitlines()), offset + end
+
+
+def start_change_feed(backend, catalog, since=None, preload=None):
+    """Starts the feed that suits the primary backend; since is its position
+    from before the catalog was loaded (the MongoDB cluster time or the
+    SQLite change log sequence; the library file catalog records its own),
+    and preload lists the books for a catalog that was left empty. The
+    feed's warnings are added to the backend's."""
+    if isinstance(backend, MongoBackend):
+        feed = MongoChangeFeed(catalog, backend.collection, since)
+    elif isinstance(backend, SqliteBackend):
+        feed = SqliteChangeFeed(catalog, backend, since)
+    else:
+        feed = JournalFeed(catalog, since)
+    feed.warnings = backend.warnings
+    feed.preload = preload
+    return feed.start()
@@ -0,0 +1,200 @@
+"""Finds and merges duplicate books.
+
+Two books are duplicates when their keys match (books.book_key: title and
+author case-folded, without accents or punctuation). One streaming pass
+over the store groups the books by key in a dict, so finding them is O(n).
+With --fuzzy, a book whose key is new is also compared with the groups in
+its block (the same longest author word and the same start of the title),
+which catches typos, initials and reordered names while the comparisons
+stay few.
+
+Each group is merged into its oldest book: it becomes read if any copy
+was, takes a year or genre only the others had, and the others are
+removed. Books stored before keys were kept get theirs filled in, so the
+unique key index covers them. Without --merge nothing is changed.
+
+    python dedupe.py --mongo-uri "$DATABASE"
+    python dedupe.py --backend sqlite --sqlite library.db --fuzzy --report duplicates.csv
+    python dedupe.py --backend json --merge
+"""
+import argparse
+import csv
+import os
+import sys
+from difflib import SequenceMatcher
+
+from books import book_key
+from storage import LOAD_PROJECTION, JsonBackend, MongoBackend, SqliteBackend
+
+
+DEDUPE_BATCH_SIZE = 1000
+FUZZY_RATIO = 0.9
+FUZZY_TITLE_PREFIX = 4
+TITLE_STOPWORDS = {"a", "an", "the"}
+SUMMARY_FIELDS = ["id", "title", "author", "year", "genre", "read", "date_added", "key"]
+REPORT_FIELDS = ["group", "action", "id", "title", "author", "year", "genre", "read", "date_added"]
+
+
+def iter_library(backend):
+    # MongoDB through a cursor of its own, since the export cursor leaves out the stored keys.
+    if isinstance(backend, MongoBackend):
+        for book in backend.collection.find({"id": {"$exists": True}}, LOAD_PROJECTION).batch_size(DEDUPE_BATCH_SIZE):
+            book.pop("_id", None)
+            yield book
+    else:
+        yield from backend.iter_books("All", "All", "Added")
+
+
+def title_core(title):
+    return " ".join(word for word in title.split() if word not in TITLE_STOPWORDS)
+
+
+def find_duplicates(books, fuzzy=False):
+    """Groups books by key in one pass.
+
+    Returns (groups, missing_keys, scanned): the groups of two or more books,
+    oldest first, the key of every book whose stored key is missing or stale,
+    by id, and the number of books read.
+    """
+    groups = {}
+    blocks = {}
+    missing_keys = {}
+    scanned = 0
+    for book in books:
+        scanned += 1
+        summary = {field: book.get(field) for field in SUMMARY_FIELDS}
+        key = book_key(summary["title"], summary["author"])
+        if summary["key"] != key:
+            missing_keys[summary["id"]] = key
+        if fuzzy and key not in groups:
+            # Normalized text has no punctuation, so the separator is unambiguous.
+            title, author = key.split("|")
+            core = title_core(title)
+            names = "".join(sorted(author.split()))
+            block = blocks.setdefault((max(author.split(), key=len, default=""), core[:FUZZY_TITLE_PREFIX]), [])
+            for representative_core, representative_names, group_key in block:
+                if (SequenceMatcher(None, core, representative_core).ratio() >= FUZZY_RATIO
+                        and SequenceMatcher(None, names, representative_names).ratio() >= FUZZY_RATIO):
+                    key = group_key
+                    break
+            else:
+                block.append((core, names, key))
+        groups.setdefault(key, []).append(summary)
+    duplicates = [sorted(group, key=lambda book: book["id"]) for group in groups.values() if len(group) > 1]
+    return duplicates, missing_keys, scanned
+
+
+def plan_merge(groups, missing_keys):
+    """The journal-format changes that merge each group into its first book
+    and fill in the missing keys. Removals come first, so no key is written
+    while a book about to be removed still holds it."""
+    missing_keys = dict(missing_keys)
+    removals = []
+    updates = []
+    for keeper, *others in groups:
+        fields = {}
+        if not keeper.get("read") and any(book.get("read") for book in others):
+            fields["read"] = True
+        if keeper.get("year") is None:
+            year = next((book["year"] for book in others if book.get("year") is not None), None)
+            if year is not None:
+                fields["year"] = year
+        if keeper.get("genre") in (None, "", "Other"):
+            genre = next((book["genre"] for book in others if book.get("genre") not in (None, "", "Other")), None)
+            if genre is not None:
+                fields["genre"] = genre
+        for book in others:
+            removals.append({"op": "remove", "id": book["id"]})
+            missing_keys.pop(book["id"], None)
+        if keeper["id"] in missing_keys:
+            fields["key"] = missing_keys.pop(keeper["id"])
+        if fields:
+            updates.append({"op": "update", "id": keeper["id"], "fields": fields})
+    updates.extend({"op": "update", "id": book_id, "fields": {"key": key}} for book_id, key in missing_keys.items())
+    return removals + updates
+
+
+def apply_merge(changes, write_batch, batch_size=DEDUPE_BATCH_SIZE, progress=None):
+    """Passes changes to write_batch in lists of batch_size, in order.
+    progress, if given, is called with (applied, total) after every batch."""
+    for start in range(0, len(changes), batch_size):
+        write_batch(changes[start:start + batch_size])
+        if progress:
+            progress(min(start + batch_size, len(changes)), len(changes))
+    return len(changes)
+
+
+def report_rows(groups):
+    for number, group in enumerate(groups, start=1):
+        for position, book in enumerate(group):
+            yield {**book, "group": number, "action": "keep" if position == 0 else "remove"}
+
+
+def write_report(groups, file):
+    writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(report_rows(groups))
+
+
+def open_backend(args):
+    if args.backend == "json":
+        return JsonBackend(args.library_file, args.journal_file)
+    if args.backend == "sqlite":
+        return SqliteBackend(args.sqlite)
+    if not args.mongo_uri:
+        raise SystemExit("the mongodb backend needs --mongo-uri (or $DATABASE)")
+    from pymongo import MongoClient
+    return MongoBackend(MongoClient(args.mongo_uri)["personal_library"]["books"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find duplicate books and merge them.")
+    parser.add_argument("--backend", choices=["mongodb", "sqlite", "json"], default=os.environ.get("STORAGE_BACKEND", "mongodb"))
+    parser.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB connection string (default: $DATABASE)")
+    parser.add_argument("--sqlite", default="library.db", help="SQLite library database")
+    parser.add_argument("--library-file", default="library.json")
+    parser.add_argument("--journal-file", default="library.journal")
+    parser.add_argument("--fuzzy", action="store_true", help="also group books whose titles differ by a typo")
+    parser.add_argument("--merge", action="store_true", help="merge the duplicates (default: only report them)")
+    parser.add_argument("--report", help="write every duplicate group to this CSV file")
+    parser.add_argument("--batch-size", type=int, default=DEDUPE_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    backend = open_backend(args)
+    groups, missing_keys, scanned = find_duplicates(iter_library(backend), args.fuzzy)
+    changes = plan_merge(groups, missing_keys)
+    removed = sum(len(group) - 1 for group in groups)
+    keyed = sum(1 for change in changes if "key" in change.get("fields", {}))
+    print(f"{scanned} books: {len(groups)} duplicate groups, {removed} books to remove, {keyed} keys to fill in",
+          file=sys.stderr)
+    for group in groups[:10]:
+        print(f"  {group[0]['title']!r} by {group[0]['author']}: {len(group)} copies", file=sys.stderr)
+    if args.report:
+        with open(args.report, "w", newline="") as file:
+            write_report(groups, file)
+        print(f"report written to {args.report}", file=sys.stderr)
+    if not args.merge:
+        if changes:
+            print("dry run; pass --merge to apply", file=sys.stderr)
+        return 0
+
+    def progress(applied, total):
+        print(f"\rapplied {applied} of {total} changes", end="", file=sys.stderr, flush=True)
+
+    rejected = []
+    apply_merge(changes, lambda batch: rejected.extend(backend.apply_changes(batch)), args.batch_size, progress)
+    print(file=sys.stderr)
+    if rejected:
+        print(f"{len(rejected)} changes skipped: they would have duplicated a key stored since the scan", file=sys.stderr)
+    # With the duplicates gone, the unique key index can be built.
+    if isinstance(backend, MongoBackend):
+        backend.prepare()
+    elif isinstance(backend, SqliteBackend):
+        backend = SqliteBackend(args.sqlite)
+    for warning in backend.warnings:
+        print(warning, file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""Streaming export of the library to CSV, JSON Lines or Parquet.
+
+Books are read in fixed-size batches in the order of any Library-tab filter
+and sort, and written out batch by batch, so memory use does not grow with the
+size of the collection.
+
+    python export_books.py unread.parquet --status Unread --sort "Year (Newest)"
+    python export_books.py fiction.csv --genre Fiction --library-file library.json
+    python export_books.py all.jsonl --sqlite library.db
+"""
+import argparse
+import csv
+import heapq
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+from books import SORT_OPTIONS, build_filter_query, build_sort_spec, iter_stored_books, matches_filter, sort_value
+
+
+EXPORT_FORMATS = ["csv", "jsonl", "parquet"]
+EXPORT_FIELDS = ["id", "title", "author", "year", "genre", "read", "date_added"]
+EXPORT_BATCH_SIZE = 5000
+EXPORT_MIME_TYPES = {"csv": "text/csv", "jsonl": "application/jsonl", "parquet": "application/vnd.apache.parquet"}
+
+
+def iter_mongo_books(collection, filter_status, filter_genre, sort_by, batch_size=EXPORT_BATCH_SIZE):
+    projection = {field: 1 for field in EXPORT_FIELDS}
+    cursor = (collection.find(build_filter_query(filter_status, filter_genre), projection)
+              .sort(build_sort_spec(sort_by))
+              .batch_size(batch_size))
+    for book in cursor:
+        book.pop("_id", None)
+        yield book
+
+
+def iter_file_books(library_file, journal_file, filter_status, filter_genre, sort_by, batch_size=EXPORT_BATCH_SIZE):
+    books = (book for book in iter_stored_books(library_file, journal_file)
+             if matches_filter(book, filter_status, filter_genre))
+    return external_sort(books, sort_by, batch_size)
+
+
+def external_sort(books, sort_by, batch_size=EXPORT_BATCH_SIZE):
+    # Sorts batch_size books at a time into temporary runs and merges them, so
+    # at most one batch per run is in memory.
+    field, direction, default = SORT_OPTIONS[sort_by]
+    descending = direction < 0
+
+    def sort_key(book):
+        return (sort_value(book.get(field, default)), str(book.get("id", "")))
+
+    runs = []
+    try:
+        while True:
+            batch = list(itertools.islice(books, batch_size))
+            if not batch:
+                break
+            batch.sort(key=sort_key, reverse=descending)
+            if not runs and len(batch) < batch_size:
+                yield from batch
+                return
+            run = tempfile.TemporaryFile("w+")
+            run.writelines(json.dumps(book) + "\n" for book in batch)
+            run.seek(0)
+            runs.append(run)
+        yield from heapq.merge(*((json.loads(line) for line in run) for run in runs), key=sort_key, reverse=descending)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def export_books(books, file, file_format, batch_size=EXPORT_BATCH_SIZE):
+    """Writes books to the binary file object in batches. Returns the number written."""
+    written = 0
+    batches = iter(lambda: list(itertools.islice(books, batch_size)), [])
+
+    if file_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.schema([
+            ("id", pa.string()), ("title", pa.string()), ("author", pa.string()), ("year", pa.int64()),
+            ("genre", pa.string()), ("read", pa.bool_()), ("date_added", pa.string()),
+        ])
+        with pq.ParquetWriter(file, schema) as writer:
+            for batch in batches:
+                columns = {field: [book.get(field) for book in batch] for field in EXPORT_FIELDS}
+                writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+                written += len(batch)
+        return written
+
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+    try:
+        if file_format == "csv":
+            writer = csv.DictWriter(text, fieldnames=EXPORT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            for batch in batches:
+                writer.writerows(batch)
+                written += len(batch)
+        else:
+            for batch in batches:
+                text.writelines(json.dumps({field: book.get(field) for field in EXPORT_FIELDS}, default=str) + "\n" for book in batch)
+                written += len(batch)
+        text.flush()
+    finally:
+        # Leave the caller's file open
+        text.detach()
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the library to CSV, JSON Lines or Parquet.")
+    parser.add_argument("output", help="file to write; the format is taken from its extension")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="output format (default: from the extension)")
+    parser.add_argument("--status", choices=["All", "Read", "Unread"], default="All")
+    parser.add_argument("--genre", default="All")
+    parser.add_argument("--sort", choices=list(SORT_OPTIONS), default="Title (A-Z)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--mongo-uri", default=os.environ.get("DATABASE"), help="MongoDB connection string (default: $DATABASE)")
+    source.add_argument("--library-file", help="export from this library snapshot instead of MongoDB")
+    source.add_argument("--sqlite", help="export from this SQLite library database instead of MongoDB")
+    parser.add_argument("--journal", default="library.journal", help="journal replayed on top of --library-file")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    file_format = args.format or os.path.splitext(args.output)[1].lower().lstrip(".")
+    if file_format not in EXPORT_FORMATS:
+        parser.error(f"unsupported output format '{file_format}'; use --format")
+    if args.library_file:
+        books = iter_file_books(args.library_file, args.journal, args.status, args.genre, args.sort, args.batch_size)
+    elif args.sqlite:
+        from storage import SqliteBackend
+        books = SqliteBackend(args.sqlite).iter_books(args.status, args.genre, args.sort)
+    elif args.mongo_uri:
+        from pymongo import MongoClient
+        collection = MongoClient(args.mongo_uri)["personal_library"]["books"]
+        books = iter_mongo_books(collection, args.status, args.genre, args.sort, args.batch_size)
+    else:
+        parser.error("either --mongo-uri (or $DATABASE) or --library-file is required")
+
+    with open(args.output, "wb") as file:
+        written = export_books(books, file, file_format, args.batch_size)
+    print(f"exported {written} books to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,109 @@
 
 import streamlit as st
-import json
+import html
+import io
 import os
-import random
-from datetime import datetime
-from pymongo import MongoClient
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from cachetools import LRUCache, TTLCache
+from pymongo import MongoClient, timeout as mongo_timeout
+from books import GENRES, SORT_OPTIONS, new_book, validate_book
+from export_books import EXPORT_FORMATS, EXPORT_MIME_TYPES, export_books
+from bulk_import import IMPORT_FORMATS, detect_format, import_books, iter_rows, write_rejects
+from changefeed import start_change_feed
+from dedupe import REPORT_FIELDS, apply_merge, find_duplicates, iter_library, plan_merge, report_rows
+from telemetry import Telemetry
+from storage import (
+    RECOMMENDATIONS, SEARCH_LIMIT, BookRecord, CircuitBreaker, DuplicateBookError, JsonBackend, MongoBackend, Outbox,
+    SearchResults, SqliteBackend, duplicate_message, matches_term, tokenize,
+)
+
+
+st.set_page_config(
+    page_title="Personal Library Manager",
+    page_icon="📚",
+    layout="wide",
+    initial_sidebar_state="expanded",
+)
+
+
+MONGO_DEFAULTS = {
+    "MONGO_MAX_POOL_SIZE": 100,
+    "MONGO_MIN_POOL_SIZE": 0,
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": 5000,
+    "MONGO_CONNECT_TIMEOUT_MS": 5000,
+    "MONGO_SOCKET_TIMEOUT_MS": 20000,
+    "MONGO_HEARTBEAT_FREQUENCY_MS": 10000,
+}
+
+
+def mongo_setting(name):
+    return int(st.secrets.get(name, MONGO_DEFAULTS[name]))
+
+
+def storage_setting(name, default):
+    try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        # no secrets file at all
+        return default
+
+
+# "mongodb", "sqlite" or "json"; the library file is also the fallback for the other two.
+STORAGE_BACKEND = storage_setting("STORAGE_BACKEND", "mongodb")
+SHOW_PERFORMANCE = str(storage_setting("PERFORMANCE_TAB", False)).lower() in ("true", "1", "yes")
+
+
+@st.cache_resource(show_spinner=False)
+def get_telemetry(slow_ms, log_path):
+    # One sample store per process, so the Performance tab and the metrics
+    # export cover every session.
+    return Telemetry(slow_ms, log_path)
+
+
+telemetry = get_telemetry(int(storage_setting("SLOW_QUERY_MS", 500)), storage_setting("TELEMETRY_LOG", None))
+rerun_started = time.perf_counter()
+
+
+@st.cache_resource(show_spinner=False)
+def get_mongo_client(connection_string, max_pool_size, min_pool_size, server_selection_timeout_ms,
+                     connect_timeout_ms, socket_timeout_ms, heartbeat_frequency_ms):
+    # One client (and connection pool) per process, shared by every session.
+    # Connecting is lazy, so the client exists even while the server is down.
+    return MongoClient(
+        connection_string,
+        maxPoolSize=max_pool_size,
+        minPoolSize=min_pool_size,
+        serverSelectionTimeoutMS=server_selection_timeout_ms,
+        connectTimeoutMS=connect_timeout_ms,
+        socketTimeoutMS=socket_timeout_ms,
+        heartbeatFrequencyMS=heartbeat_frequency_ms,
+    )
 
 
 def connect_to_mongodb():
     try:
         connection_string = st.secrets["DATABASE"]
-        client = MongoClient(connection_string)
+        with telemetry.measure("connect", "phase", "MongoDB"):
+            client = get_mongo_client(
+                connection_string,
+                mongo_setting("MONGO_MAX_POOL_SIZE"),
+                mongo_setting("MONGO_MIN_POOL_SIZE"),
+                mongo_setting("MONGO_SERVER_SELECTION_TIMEOUT_MS"),
+                mongo_setting("MONGO_CONNECT_TIMEOUT_MS"),
+                mongo_setting("MONGO_SOCKET_TIMEOUT_MS"),
+                mongo_setting("MONGO_HEARTBEAT_FREQUENCY_MS"),
+            )
         db = client["personal_library"]
         collection = db["books"]
-        client.admin.command('ping')
         return collection
     except Exception as e:
         st.error(f"MongoDB Connection Error: {e}")
         return None
 
 
-if 'mongo_collection' not in st.session_state:
-    st.session_state.mongo_collection = connect_to_mongodb()
-
-if 'mongo_available' not in st.session_state:
-    st.session_state.mongo_available = st.session_state.mongo_collection is not None
-
-
-st.set_page_config(
-    page_title="Personal Library Manager",
-    page_icon="📚",
-    layout="wide",
-    initial_sidebar_state="expanded",
-)
-
 st.markdown("""
 <style>
     .welcome-banner {
@@ -193,361 +263,685 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-def load_library():
-    if st.session_state.mongo_available:
-        try:
-            cursor = st.session_state.mongo_collection.find({})
-            library = []
-            for doc in cursor:
-                doc['_id'] = str(doc['_id'])
-                
-                if 'read' not in doc:
-                    doc['read'] = False
-                if 'id' not in doc:
-                    doc['id'] = str(random.randint(10000, 99999))
-                
-                library.append(doc)
-            return library
-        except Exception as e:
-            st.error(f"Error loading from MongoDB: {e}")
-            return load_from_file()
+LIBRARY_FILE = "library.json"
+JOURNAL_FILE = "library.journal"
+OUTBOX_FILE = "library.outbox"
+PAGE_SIZES = [10, 25, 50, 100]
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 300
+# Sessions rerun on their own when another session or process changed the library.
+CHANGE_FEED = str(storage_setting("CHANGE_FEED", True)).lower() in ("true", "1", "yes")
+LIVE_REFRESH_SECONDS = int(storage_setting("LIVE_REFRESH_MS", 2000)) / 1000
+# Draws the page before the local copy of MongoDB or SQLite is loaded, and
+# only builds the view that is open.
+LAZY_START = str(storage_setting("LAZY_START", False)).lower() in ("true", "1", "yes")
+CARD_CACHE_SIZE = 4096
+
+
+@st.cache_resource(show_spinner=False)
+def get_storage(backend_name, _collection=None):
+    # One backend, one shared catalog and one circuit breaker per process. When
+    # MongoDB or SQLite is primary, the catalog mirrors it and takes over
+    # while the breaker is open.
+    if backend_name == "json":
+        catalog = JsonBackend(LIBRARY_FILE, JOURNAL_FILE)
+        if CHANGE_FEED:
+            start_change_feed(catalog, catalog)
+        return catalog, catalog, None
+    if backend_name == "mongodb":
+        backend = MongoBackend(_collection)
     else:
-        return load_from_file()
+        backend = SqliteBackend(storage_setting("SQLITE_PATH", "library.db"))
+    outbox = Outbox(OUTBOX_FILE)
+    breaker = CircuitBreaker(
+        backend,
+        outbox,
+        int(storage_setting("BREAKER_FAILURES", 3)),
+        int(storage_setting("BREAKER_PROBE_INTERVAL_MS", 5000)) / 1000,
+    )
+    since = preload = None
+    breaker.on_recovery = lambda: resync_catalog(backend, catalog)
+    try:
+        if backend_name == "mongodb":
+            # Fails within one server selection timeout if the server is down.
+            backend.ping()
+            backend.prepare()
+        # Changes buffered during an outage before the last shutdown.
+        outbox.replay(backend)
+        # The feed's position before anything is loaded, so nothing written
+        # while the catalog loads is missed.
+        if backend_name == "sqlite":
+            since = backend.last_change()
+        else:
+            since = backend.operation_time()
+        if LAZY_START and CHANGE_FEED and (backend_name == "mongodb" or backend.count("All", "All")):
+            # Reads go to the backend, so the local copy can be filled in by
+            # the change feed once it holds its position.
+            catalog = JsonBackend(LIBRARY_FILE, JOURNAL_FILE, [])
+            preload = backend.load
+        else:
+            books = backend.load()
+            if not books and backend_name == "sqlite" and os.path.exists(LIBRARY_FILE):
+                # First start on SQLite: bring over the library kept in file mode.
+                books = JsonBackend(LIBRARY_FILE, JOURNAL_FILE).books
+                backend.save(books)
+            catalog = JsonBackend(LIBRARY_FILE, JOURNAL_FILE, books)
+    except Exception as e:
+        st.error(f"Error loading from {backend.name}: {e}")
+        catalog = JsonBackend(LIBRARY_FILE, JOURNAL_FILE)
+        breaker.on_recovery = lambda: resync_catalog(backend, catalog, prepare=True)
+        breaker.trip()
+    if CHANGE_FEED:
+        start_change_feed(backend, catalog, since, preload)
+    return backend, catalog, breaker
 
 
-def load_from_file():
-    if os.path.exists("library.json"):
-        try:
-            with open("library.json", "r") as file:
-                library = json.load(file)
-                for book in library:
-                    if 'read' not in book:
-                        book['read'] = False
-                    if 'id' not in book:
-                        book['id'] = str(random.randint(10000, 99999))
-                return library
-        except json.JSONDecodeError:
-            st.error("Error loading library file. Starting with an empty library.")
-    return []
+def bump_catalog_version(catalog):
+    with catalog.lock:
+        catalog.version += 1
 
 
-def save_library(library):
-    if st.session_state.mongo_available:
+def resync_catalog(backend, catalog, prepare=False):
+    # After an outage the catalog may still be the library file (if startup
+    # failed) or be missing what other processes wrote in the meantime.
+    if prepare and isinstance(backend, MongoBackend):
+        backend.prepare()
+    catalog.merge_library(backend.load())
+    bump_catalog_version(catalog)
+
+
+def bump_library_version():
+    # Anything cached against the library (search results, stats, ...) is keyed
+    # on this counter, so bumping it is the only invalidation needed.
+    bump_catalog_version(st.session_state.catalog)
+    if "search_cache" in st.session_state:
+        st.session_state.search_cache.clear()
+
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS if CHANGE_FEED and LIVE_REFRESH_SECONDS > 0 else None)
+def follow_catalog():
+    # Reruns the page once the catalog moved past the version it was drawn from.
+    if st.session_state.catalog.version != st.session_state.get("drawn_version"):
+        st.rerun(scope="app")
+
+
+def primary_backend():
+    # None when the catalog itself is the primary store (file mode), or while
+    # the breaker is open and the primary is not worth waiting for.
+    backend = st.session_state.backend
+    if backend is st.session_state.catalog or not st.session_state.breaker.allow():
+        return None
+    return backend
+
+
+QUERY_WORKERS = 16
+QUERY_TIMEOUT = int(storage_setting("QUERY_TIMEOUT_MS", 5000)) / 1000
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_pool():
+    # Shared by every session, like the MongoDB connection pool it feeds.
+    return ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="library-query")
+
+
+def profiled_call(backend, method, args):
+    with telemetry.measure(method, "query", backend.name, args, lambda: backend.explain(method, args)) as record:
+        result = getattr(backend, method)(*args)
+        record(result)
+    return result
+
+
+def timed_call(backend, method, args, timeout):
+    # Lets MongoDB abort the operation server-side once the timeout is spent.
+    with mongo_timeout(timeout):
+        return profiled_call(backend, method, args)
+
+
+def read_backend_concurrently(reads, timeout=QUERY_TIMEOUT):
+    """Runs independent reads against the primary backend at the same time.
+
+    reads maps a name to (method, args, action), where action completes the
+    error message ("counting books in"). A read that fails or takes longer
+    than timeout seconds is answered from the shared catalog instead, so a
+    rerun waits for the slowest query rather than the sum of all of them.
+    """
+    backend = primary_backend()
+    catalog = st.session_state.catalog
+    futures = {}
+    if backend is not None:
+        pool = get_query_pool()
+        for name, (method, args, _) in reads.items():
+            futures[name] = pool.submit(timed_call, backend, method, args, timeout)
+    deadline = time.monotonic() + timeout
+    results = {}
+    for name, (method, args, action) in reads.items():
+        if name in futures:
+            try:
+                results[name] = futures[name].result(timeout=max(0, deadline - time.monotonic()))
+                st.session_state.breaker.record_success()
+                continue
+            except FutureTimeoutError:
+                futures[name].cancel()
+                st.session_state.breaker.record_failure()
+                st.error(f"Error {action} {backend.name}: no answer within {timeout:g}s")
+            except Exception as e:
+                st.session_state.breaker.record_failure()
+                st.error(f"Error {action} {backend.name}: {e}")
+        results[name] = profiled_call(catalog, method, args)
+    return results
+
+
+def read_backend(method, args, action):
+    return read_backend_concurrently({method: (method, args, action)})[method]
+
+
+def write_backend(method, args, action, offline):
+    """Applies a write to the primary backend and returns (result, True).
+
+    If the backend fails, or the breaker is open, offline() is called instead:
+    it applies the change to the catalog and returns (result, changes), and
+    the changes are kept in the outbox until the backend is back. Returns
+    (result, False) then.
+    """
+    backend = primary_backend()
+    if backend is not None:
         try:
-            st.session_state.mongo_collection.delete_many({})
-            if library:
-                for book in library:
-                    book_copy = book.copy()
-                    if '_id' in book_copy and isinstance(book_copy['_id'], str):
-                        del book_copy['_id']
-                    if 'read' not in book_copy:
-                        book_copy['read'] = False
-                    if 'id' not in book_copy:
-                        book_copy['id'] = str(random.randint(10000, 99999))
-                    st.session_state.mongo_collection.insert_one(book_copy)
-            return True
+            result = timed_call(backend, method, args, QUERY_TIMEOUT)
+            st.session_state.breaker.record_success()
+            return result, True
+        except DuplicateBookError:
+            # The backend answered; it refused the book.
+            st.session_state.breaker.record_success()
+            raise
         except Exception as e:
-            st.error(f"Error saving to MongoDB: {e}")
-            return save_to_file(library)
-    else:
-        return save_to_file(library)
+            st.session_state.breaker.record_failure()
+            st.error(f"Error {action} {backend.name}: {e}. The change was kept locally and will be synced later.")
+    result, changes = offline()
+    st.session_state.breaker.buffer(changes)
+    return result, False
 
 
-def save_to_file(library):
-    with open("library.json", "w") as file:
-        json.dump(library, file, indent=4)
-        return True
+def save_library(library):
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        saved = profiled_call(catalog, "save", (library,))
+        bump_library_version()
+        return saved
 
+    def offline():
+        current = {book['id'] for book in library}
+        with catalog.lock:
+            removed = [book_id for book_id in catalog.index.by_id if book_id not in current]
+        changes = [{"op": "add", "book": book} for book in library] + [{"op": "remove", "id": book_id} for book_id in removed]
+        return len(changes), changes
 
-if 'library' not in st.session_state:
-    st.session_state.library = load_library()
+    saved, _ = write_backend("save", (library,), "saving to", offline)
+    if saved:
+        bump_library_version()
+    return saved
 
 
 def add_book(title, author, year, genre, read_status):
-    if not title or not author:
-        st.error("Title and author are required.")
-        return False
     try:
-        year = int(year)
-        if not (0 <= year <= datetime.now().year):
-            st.error(f"Year must be between 0 and {datetime.now().year}.")
-            return False
-    except ValueError:
-        st.error("Year must be a valid Number.")
+        year = validate_book(title, author, year)
+    except ValueError as e:
+        st.error(str(e))
         return False
     
-    book = {
-        "id": str(random.randint(10000, 99999)),
-        "title": title,
-        "author": author,
-        "year": year,
-        "genre": genre,
-        "read": read_status,
-        "date_added": datetime.now().strftime("%Y-%m-%d")
-    }
+    book = BookRecord(new_book(title, author, year, genre, read_status))
     
-    if st.session_state.mongo_available:
-        try:
-            result = st.session_state.mongo_collection.insert_one(book)
-            book['_id'] = str(result.inserted_id)
-            st.session_state.library.append(book)
-            return True
-        except Exception as e:
-            st.error(f"Error adding book to MongoDB: {e}")
-            st.session_state.library.append(book)
-            save_to_file(st.session_state.library)
-            return True
-    else:
-        st.session_state.library.append(book)
-        save_to_file(st.session_state.library)
-        return True
+    catalog = st.session_state.catalog
+    try:
+        if catalog.duplicate_of(book) is not None:
+            raise DuplicateBookError(duplicate_message(book))
+        if st.session_state.backend is catalog:
+            profiled_call(catalog, "insert", (book,))
+        else:
+            write_backend("insert", (book,), "adding book to", lambda: (None, [{"op": "add", "book": book}]))
+            catalog.remember(book)
+    except DuplicateBookError as e:
+        st.error(str(e))
+        return False
+    bump_library_version()
+    return True
+
+
+def import_book_batch(books):
+    # Returns the books the store refused as duplicates; the rest are written.
+    # The catalog can be behind the store (a lazy start, no change stream,
+    # another process), so its own duplicate check does not catch them all.
+    records = [BookRecord(book) for book in books]
+    catalog = st.session_state.catalog
+    refused = []
+    try:
+        if st.session_state.backend is catalog:
+            profiled_call(catalog, "insert_many", (records,))
+            return []
+        write_backend("insert_many", (records,), "importing books into",
+                      lambda: (None, [{"op": "add", "book": record} for record in records]))
+    except DuplicateBookError as e:
+        refused = e.books
+        if st.session_state.backend is catalog:
+            return refused
+    refused_ids = {book['id'] for book in refused}
+    for record in records:
+        if record['id'] not in refused_ids:
+            catalog.remember(record)
+    return refused
+
+
+def import_uploaded_books(upload, progress=None):
+    try:
+        file_format = detect_format(upload.name)
+    except ValueError as e:
+        st.error(str(e))
+        return 0, []
+    catalog = st.session_state.catalog
+    written = []
+
+    def write_batch(books):
+        refused = import_book_batch(books)
+        written.append(len(books) - len(refused))
+        return refused
+
+    try:
+        imported, rejects = import_books(
+            iter_rows(upload, file_format), write_batch, progress=progress,
+            is_duplicate=lambda book: catalog.duplicate_of(book) is not None,
+        )
+    except Exception as e:
+        # The batches written before the failure stay imported.
+        imported, rejects = sum(written), []
+        st.error(f"Import stopped after {imported} books: {e}")
+    if imported:
+        bump_library_version()
+    return imported, rejects
 
 
 def remove_book(book_id):
-    if st.session_state.mongo_available:
-        try:
-            st.session_state.mongo_collection.delete_one({"id": book_id})
-            st.session_state.library = [book for book in st.session_state.library if book.get("id") != book_id]
-            return True
-        except Exception as e:
-            st.error(f"Error removing book from MongoDB: {e}")
-            for i, book in enumerate(st.session_state.library):
-                if book.get("id") == book_id:
-                    del st.session_state.library[i]
-                    save_to_file(st.session_state.library)
-                    return True
-            return False
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        removed = profiled_call(catalog, "delete", (book_id,))
     else:
-        for i, book in enumerate(st.session_state.library):
-            if book.get("id") == book_id:
-                del st.session_state.library[i]
-                save_to_file(st.session_state.library)
-                return True
+        def offline():
+            removed = catalog.forget(book_id) is not None
+            return removed, [{"op": "remove", "id": book_id}] if removed else []
+
+        removed, written = write_backend("delete", (book_id,), "removing book from", offline)
+        if written:
+            catalog.forget(book_id)
+    if not removed:
         return False
+    bump_library_version()
+    return True
 
 
 def toggle_read_status(book_id):
-    if st.session_state.mongo_available:
-        try:
-            book = st.session_state.mongo_collection.find_one({"id": book_id})
-            if book:
-                if 'read' not in book:
-                    book['read'] = False
-                new_status = not book["read"]
-                st.session_state.mongo_collection.update_one(
-                    {"id": book_id},
-                    {"$set": {"read": new_status}}
-                )
-                for book in st.session_state.library:
-                    if book.get("id") == book_id:
-                        book["read"] = new_status
-                return True
-            return False
-        except Exception as e:
-            st.error(f"Error updating book status in MongoDB: {e}")
-            for book in st.session_state.library:
-                if book.get("id") == book_id:
-                    # Ensure 'read' field exists
-                    if 'read' not in book:
-                        book['read'] = False
-                    book["read"] = not book["read"]
-                    save_to_file(st.session_state.library)
-                    return True
-            return False
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        read = profiled_call(catalog, "toggle", (book_id,))
     else:
-        for book in st.session_state.library:
-            if book.get("id") == book_id:
-                # Ensure 'read' field exists
-                if 'read' not in book:
-                    book['read'] = False
-                book["read"] = not book["read"]
-                save_to_file(st.session_state.library)
-                return True
+        def offline():
+            book = catalog.index.get(book_id)
+            if book is None:
+                return None, []
+            read = not book.get("read", False)
+            catalog.mark_read(book_id, read)
+            # The new value rather than a toggle, so replaying it twice is harmless.
+            return read, [{"op": "update", "id": book_id, "fields": {"read": read}}]
+
+        read, written = write_backend("toggle", (book_id,), "updating book status in", offline)
+        if written and read is not None:
+            catalog.mark_read(book_id, read)
+    if read is None:
         return False
+    bump_library_version()
+    return True
 
 
-def search_books(search_term, search_by):
-    search_term = search_term.lower()
-    if st.session_state.mongo_available:
-        try:
-            query = {search_by: {"$regex": search_term, "$options": "i"}}
-            if search_by == "year" and search_term.isdigit():
-                query = {search_by: int(search_term)}
-            
-            cursor = st.session_state.mongo_collection.find(query)
-            results = list(cursor)
-            for book in results:
-                book['_id'] = str(book['_id'])
-                # Ensure required fields exist
-                if 'read' not in book:
-                    book['read'] = False
-                if 'id' not in book:
-                    book['id'] = str(random.randint(10000, 99999))
-            return results
-        except Exception as e:
-            st.error(f"Error searching books in MongoDB: {e}")
-            results = [book for book in st.session_state.library 
-                    if search_term in str(book.get(search_by, "")).lower()]
-            for book in results:
-                if 'read' not in book:
-                    book['read'] = False
-                if 'id' not in book:
-                    book['id'] = str(random.randint(10000, 99999))
-            return results
+def set_read_status(book_ids, read):
+    # One update for the whole selection, so a large batch costs one write and one rerun.
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        changed = profiled_call(catalog, "set_read_many", (book_ids, read))
     else:
-        results = [book for book in st.session_state.library 
-                if search_term in str(book.get(search_by, "")).lower()]
-        for book in results:
-            if 'read' not in book:
-                book['read'] = False
-            if 'id' not in book:
-                book['id'] = str(random.randint(10000, 99999))
-        return results
+        def offline():
+            changed = [book_id for book_id in book_ids if catalog.mark_read(book_id, read) is not None]
+            return len(changed), [{"op": "update", "id": book_id, "fields": {"read": read}} for book_id in changed]
 
+        changed, written = write_backend("set_read_many", (book_ids, read), "updating books in", offline)
+        if written:
+            for book_id in book_ids:
+                catalog.mark_read(book_id, read)
+    if changed:
+        bump_library_version()
+    return changed
 
-def get_statistics():
-    if st.session_state.mongo_available:
-        try:
-            total_books = st.session_state.mongo_collection.count_documents({})
-            read_books = st.session_state.mongo_collection.count_documents({"read": True})
-            percentage_read = (read_books / total_books * 100) if total_books > 0 else 0
-            return {
-                "total": total_books,
-                "read": read_books,
-                "unread": total_books - read_books,
-                "percentage": percentage_read
-            }
-        except Exception as e:
-            st.error(f"Error getting statistics from MongoDB: {e}")
-            return get_statistics_from_memory()
+
+def remove_books(book_ids):
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        removed = profiled_call(catalog, "delete_many", (book_ids,))
     else:
-        return get_statistics_from_memory()
-
-
-def get_statistics_from_memory():
-    total_books = len(st.session_state.library)
-    # Ensure each book has required fields before counting
-    for book in st.session_state.library:
-        if 'read' not in book:
-            book['read'] = False
-        if 'id' not in book:
-            book['id'] = str(random.randint(10000, 99999))
-    read_books = sum(1 for book in st.session_state.library if book.get("read", False))
-    percentage_read = (read_books / total_books * 100) if total_books > 0 else 0
-    return {
-        "total": total_books,
-        "read": read_books,
-        "unread": total_books - read_books,
-        "percentage": percentage_read
-    }
+        def offline():
+            removed = [book_id for book_id in book_ids if catalog.forget(book_id) is not None]
+            return len(removed), [{"op": "remove", "id": book_id} for book_id in removed]
+
+        removed, written = write_backend("delete_many", (book_ids,), "removing books from", offline)
+        if written:
+            for book_id in book_ids:
+                catalog.forget(book_id)
+    if removed:
+        bump_library_version()
+    return removed
+
+
+def merge_duplicate_batch(changes):
+    catalog = st.session_state.catalog
+    if st.session_state.backend is catalog:
+        profiled_call(catalog, "apply_changes", (changes,))
+        return
+
+    def offline():
+        catalog.merge_changes(changes)
+        return None, changes
+
+    rejected, written = write_backend("apply_changes", (changes,), "merging duplicates in", offline)
+    if written:
+        catalog.merge_changes([change for change in changes if change not in (rejected or [])])
+
+
+def find_duplicate_books(fuzzy):
+    # Streamed from the primary store, which may hold books the catalog has not loaded yet.
+    backend = primary_backend() or st.session_state.catalog
+    try:
+        with telemetry.measure("find duplicates", "query", backend.name):
+            groups, missing_keys, _ = find_duplicates(iter_library(backend), fuzzy)
+    except Exception as e:
+        st.error(f"Error looking for duplicates in {backend.name}: {e}")
+        return
+    st.session_state.duplicates = (st.session_state.catalog.version, groups, plan_merge(groups, missing_keys))
+
+
+def merge_duplicates(changes):
+    apply_merge(changes, merge_duplicate_batch)
+    st.session_state.duplicates = None
+    bump_library_version()
+
+
+def select_books(book_ids, selected):
+    for book_id in book_ids:
+        if selected:
+            st.session_state.selected_books.add(book_id)
+        else:
+            st.session_state.selected_books.discard(book_id)
+        st.session_state[f"select_{book_id}"] = selected
+
+
+def update_selection(book_id):
+    select_books([book_id], st.session_state[f"select_{book_id}"])
+
+
+def clear_selection():
+    select_books(list(st.session_state.selected_books), False)
+
+
+def search_books(search_term, search_by, limit=SEARCH_LIMIT):
+    search_term = search_term.strip().lower()
+    return read_backend("search", (search_term, search_by, limit), "searching books in")
+
+
+def cached_search(search_term, search_by):
+    term = search_term.strip().lower()
+    cache = st.session_state.search_cache
+    version = st.session_state.catalog.version
+    key = (term, search_by, version)
+    if key in cache:
+        return cache[key]
+
+    tokens = tokenize(term)
+    if search_by != "year" and tokens:
+        # Extending a term can only narrow the matches, so a shorter cached query
+        # already holds every candidate if its backend says it is complete (not
+        # cut off by the limit, and matched the way matches_term does).
+        for cut in range(len(term) - 1, 0, -1):
+            previous = cache.get((term[:cut], search_by, version))
+            if previous is None:
+                continue
+            if getattr(previous, "complete", False):
+                results = SearchResults(book for book in previous if matches_term(book, tokens, search_by))
+                results.complete = True
+                cache[key] = results
+                return results
+            break
+
+    results = search_books(term, search_by)
+    cache[key] = results
+    return results
+
+
+STATISTICS_READ = ("statistics", (), "getting statistics from")
+GENRES_READ = ("genres", (), "getting genres from")
+
+
+def cached_statistics():
+    cached = st.session_state.get("stats_cache")
+    if cached is not None and cached[0] == st.session_state.catalog.version:
+        return cached[1]
+    return None
+
+
+def remember_statistics(stats):
+    st.session_state.stats_cache = (st.session_state.catalog.version, stats)
+    return stats
+
+
+def get_statistics():
+    stats = cached_statistics()
+    if stats is None:
+        stats = remember_statistics(compute_statistics())
+    return stats
+
+
+def compute_statistics():
+    return read_backend(*STATISTICS_READ)
+
+
+def cached_genres():
+    stats = cached_statistics()
+    if stats is not None:
+        return sorted(stats["genres"])
+    cached = st.session_state.get("genres_cache")
+    if cached is not None and cached[0] == st.session_state.catalog.version:
+        return cached[1]
+    return None
+
+
+def remember_genres(genres):
+    st.session_state.genres_cache = (st.session_state.catalog.version, genres)
+    return genres
 
 
 def get_unique_genres():
-    if st.session_state.mongo_available:
-        try:
-            pipeline = [
-                {"$group": {"_id": "$genre"}},
-                {"$sort": {"_id": 1}}
-            ]
-            genres = ["All"] + [doc["_id"] for doc in st.session_state.mongo_collection.aggregate(pipeline) if doc["_id"] is not None]
-            return genres
-        except Exception as e:
-            st.error(f"Error fetching genres from MongoDB: {e}")
-            return ["All"] + sorted(list(set(book.get("genre", "Other") for book in st.session_state.library)))
-    else:
-        return ["All"] + sorted(list(set(book.get("genre", "Other") for book in st.session_state.library)))
+    genres = cached_genres()
+    if genres is None:
+        if LAZY_START:
+            # Only the genre list, not the whole statistics, when Insights may never be opened.
+            genres = remember_genres(read_backend(*GENRES_READ))
+        else:
+            genres = sorted(get_statistics()["genres"])
+    return ["All"] + genres
 
 
-def get_filtered_books(filter_status, filter_genre, sort_by):
-    if st.session_state.mongo_available:
-        try:
-            query = {}
-            if filter_status == "Read":
-                query["read"] = True
-            elif filter_status == "Unread":
-                query["read"] = False
-            if filter_genre != "All":
-                query["genre"] = filter_genre
-            
-            if sort_by == "Title (A-Z)":
-                sort_field = [("title", 1)]
-            elif sort_by == "Author (A-Z)":
-                sort_field = [("author", 1)]
-            elif sort_by == "Year (Newest)":
-                sort_field = [("year", -1)]
-            elif sort_by == "Added":
-                sort_field = [("date_added", -1)]
-            
-            cursor = st.session_state.mongo_collection.find(query).sort(sort_field)
-            filtered_library = list(cursor)
-            for book in filtered_library:
-                book['_id'] = str(book['_id'])
-                # Ensure required fields exist
-                if 'read' not in book:
-                    book['read'] = False
-                if 'id' not in book:
-                    book['id'] = str(random.randint(10000, 99999))
-            return filtered_library
-                
-        except Exception as e:
-            st.error(f"Error filtering books from MongoDB: {e}")
-            return filter_books_in_memory(filter_status, filter_genre, sort_by)
-    else:
-        return filter_books_in_memory(filter_status, filter_genre, sort_by)
+def count_filtered_books(filter_status, filter_genre):
+    return read_backend("count", (filter_status, filter_genre), "counting books in")
 
 
-def filter_books_in_memory(filter_status, filter_genre, sort_by):
-    filtered_library = st.session_state.library.copy()
-    
-    for book in filtered_library:
-        if 'read' not in book:
-            book['read'] = False
-        if 'id' not in book:
-            book['id'] = str(random.randint(10000, 99999))
-            
-    if filter_status == "Read":
-        filtered_library = [b for b in filtered_library if b.get("read", False)]
-    elif filter_status == "Unread":
-        filtered_library = [b for b in filtered_library if not b.get("read", False)]
-    if filter_genre != "All":
-        filtered_library = [b for b in filtered_library if b.get("genre") == filter_genre]
-    if sort_by == "Title (A-Z)":
-        filtered_library.sort(key=lambda x: x.get("title", ""))
-    elif sort_by == "Author (A-Z)":
-        filtered_library.sort(key=lambda x: x.get("author", ""))
-    elif sort_by == "Year (Newest)":
-        filtered_library.sort(key=lambda x: x.get("year", 0), reverse=True)
-    elif sort_by == "Added":
-        filtered_library.sort(key=lambda x: x.get("date_added", ""), reverse=True)
-    return filtered_library
+def get_filtered_books(filter_status, filter_genre, sort_by, page=1, page_size=PAGE_SIZES[1]):
+    return read_backend("page", (filter_status, filter_genre, sort_by, page, page_size), "filtering books from")
 
 
-st.markdown(
-    """
-    <div class="welcome-banner">
-        <h1 style="font-size: 24px; text-align: center;">Personal Library Manager</h1>
-    </div>
-    """,
-    unsafe_allow_html=True
-)
+def prefetch_library_view(filter_status, filter_genre, sort_by, page, page_size):
+    # The genre list (from the statistics, unless the start is lazy), the
+    # count and the page do not depend on each other, so they are fetched in
+    # one concurrent round.
+    reads = {
+        "count": ("count", (filter_status, filter_genre), "counting books in"),
+        "page": ("page", (filter_status, filter_genre, sort_by, page, page_size), "filtering books from"),
+    }
+    if cached_genres() is None:
+        if LAZY_START:
+            reads["genres"] = GENRES_READ
+        else:
+            reads["stats"] = STATISTICS_READ
+    results = read_backend_concurrently(reads)
+    if "stats" in results:
+        remember_statistics(results.pop("stats"))
+    if "genres" in results:
+        remember_genres(results.pop("genres"))
+    results["view"] = (filter_status, filter_genre, sort_by, page, page_size)
+    return results
+
+
+def export_filtered_books(filter_status, filter_genre, sort_by, file_format):
+    # Written batch by batch into a temp file that only spills to disk once large.
+    export_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    try:
+        books = (primary_backend() or st.session_state.catalog).iter_books(filter_status, filter_genre, sort_by)
+        written = export_books(books, export_file, file_format)
+    except Exception as e:
+        st.error(f"Error exporting books: {e}")
+        export_file.close()
+        return None, 0
+    # Streamlit keeps download data in memory, so the finished file is handed over as bytes.
+    export_file.seek(0)
+    with export_file:
+        return export_file.read(), written
+
+
+@st.cache_resource(show_spinner=False)
+def get_card_cache():
+    # Shared by every session: a card only depends on the fields it shows.
+    return LRUCache(maxsize=CARD_CACHE_SIZE), threading.Lock()
+
+
+def card_html(book):
+    read = bool(book.get('read', False))
+    key = (book['id'], book.get('title'), book.get('author'), book.get('year'), book.get('genre'), read)
+    cache, lock = get_card_cache()
+    with lock:
+        cached = cache.get(key)
+    if cached is not None:
+        return cached
+    # One line without indentation, so cards can be joined into a single
+    # markdown block without any of it being read as a code block.
+    card = (
+        f'<div class="book-card {"read-card" if read else "unread-card"}"><div>'
+        f'<div class="book-title">{html.escape(str(book.get("title", "No Title")))}</div>'
+        f'<div class="book-meta">by {html.escape(str(book.get("author", "Unknown")))} • '
+        f'{html.escape(str(book.get("year", "N/A")))} • {html.escape(str(book.get("genre", "Uncategorized")))}</div>'
+        f'<div style="margin-top: 0.75rem;"><span class="status-badge {"read-badge" if read else "unread-badge"}">'
+        f'{"Read" if read else "Unread"}</span></div>'
+        f'</div></div>'
+    )
+    with lock:
+        cache[key] = card
+    return card
+
+
+def render_cards(books):
+    st.markdown("".join(card_html(book) for book in books), unsafe_allow_html=True)
+
+
+def recommend_books(book_ids=None):
+    # Served by the catalog, which mirrors every backend, so no backend query is made.
+    key = (tuple(book_ids or ()), st.session_state.catalog.version)
+    cached = st.session_state.get("recommendations")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    catalog = st.session_state.catalog
+    with telemetry.measure("similar", "query", catalog.name, (book_ids,)) as record:
+        books = catalog.similar(book_ids, RECOMMENDATIONS)
+        record(books)
+    st.session_state.recommendations = (key, books)
+    return books
+
+
+def show_similar(book_id):
+    st.session_state.similar_to = book_id
+
 
-tabs = st.tabs(["📚 Library", "+ Add Book", "🔍 Search", "📊 Insights"])
+def close_similar():
+    st.session_state.similar_to = None
 
-with tabs[0]:
+
+def check_query_indexes():
+    genres = [genre for genre in get_unique_genres() if genre != "All"][:1] or ["Fiction"]
+    return st.session_state.backend.check_indexes(genres, PAGE_SIZES[1])
+
+
+def show_library():
     st.header("My Library")
+    # Widget state already holds this run's choices, so everything the tab
+    # shows can be requested before the widgets are drawn.
+    prefetched = prefetch_library_view(
+        st.session_state.get("library_status", "All"),
+        st.session_state.get("library_genre", "All"),
+        st.session_state.get("library_sort", next(iter(SORT_OPTIONS))),
+        st.session_state.get("library_page", 1),
+        st.session_state.get("library_page_size", PAGE_SIZES[1]),
+    )
     with st.container():
         col1, col2, col3 = st.columns(3)
         with col1:
-            filter_status = st.selectbox("Status", ["All", "Read", "Unread"])
+            filter_status = st.selectbox("Status", ["All", "Read", "Unread"], key="library_status")
         with col2:
             genres = get_unique_genres()
-            filter_genre = st.selectbox("Genre", genres)
+            filter_genre = st.selectbox("Genre", genres, key="library_genre")
         with col3:
-            sort_by = st.selectbox("Sort", ["Title (A-Z)", "Author (A-Z)", "Year (Newest)", "Added"])
-    
-    filtered_library = get_filtered_books(filter_status, filter_genre, sort_by)
+            sort_by = st.selectbox("Sort", list(SORT_OPTIONS), key="library_sort")
+
+    with st.expander("Export these books"):
+        col1, col2 = st.columns([1, 2])
+        with col1:
+            export_format = st.selectbox("Format", EXPORT_FORMATS, label_visibility="collapsed")
+        with col2:
+            if st.button("Prepare export"):
+                export_data, exported = export_filtered_books(filter_status, filter_genre, sort_by, export_format)
+                if export_data is not None:
+                    st.download_button(
+                        f"Download {exported} books",
+                        export_data,
+                        file_name=f"library.{export_format}",
+                        mime=EXPORT_MIME_TYPES[export_format],
+                    )
+
+    with st.expander("Find duplicates"):
+        fuzzy = st.checkbox("Also match titles that differ by a typo", key="duplicates_fuzzy")
+        if st.button("Find duplicates"):
+            find_duplicate_books(fuzzy)
+        found = st.session_state.get("duplicates")
+        if found is not None:
+            version, groups, changes = found
+            removed = sum(len(group) - 1 for group in groups)
+            if version != st.session_state.catalog.version:
+                st.info("The library has changed since; find the duplicates again.")
+            elif not groups:
+                st.success("No duplicates found.")
+            else:
+                st.markdown(f"Duplicate groups: {len(groups)} · copies to remove: {removed}. Merging keeps the oldest copy in each group.")
+                st.dataframe(list(report_rows(groups)), column_order=REPORT_FIELDS, hide_index=True, use_container_width=True)
+            if version == st.session_state.catalog.version and changes:
+                if st.button("Merge duplicates" if groups else "Store missing keys", key="merge_duplicates", type="primary"):
+                    merge_duplicates(changes)
+                    st.rerun()
+
+    if prefetched["view"][:2] == (filter_status, filter_genre):
+        total_filtered = prefetched["count"]
+    else:
+        total_filtered = count_filtered_books(filter_status, filter_genre)
 
-    if not filtered_library:
+    if total_filtered == 0:
         st.markdown("""
         <div class="empty-state">
             <div class="empty-icon">📚</div>
@@ -555,40 +949,92 @@ with tabs[0]:
         </div>
         """, unsafe_allow_html=True)
     else:
-        st.markdown(f"<p style='color: #6b7280; margin-bottom: 1rem;'>{len(filtered_library)} books</p>", unsafe_allow_html=True)
+        col1, col2, col3 = st.columns([2, 1, 1])
+        with col2:
+            page_size = st.selectbox("Per page", PAGE_SIZES, index=1, key="library_page_size")
+        total_pages = max(1, -(-total_filtered // page_size))
+        if st.session_state.get("library_page", 1) > total_pages:
+            st.session_state.library_page = total_pages
+        with col3:
+            page = st.number_input("Page", min_value=1, max_value=total_pages, step=1, key="library_page")
+        with col1:
+            st.markdown(f"<p style='color: #6b7280; margin-bottom: 1rem;'>{total_filtered} books • page {page} of {total_pages}</p>", unsafe_allow_html=True)
+
+        if prefetched["view"] == (filter_status, filter_genre, sort_by, page, page_size):
+            filtered_library = prefetched["page"]
+        else:
+            filtered_library = get_filtered_books(filter_status, filter_genre, sort_by, page, page_size)
+
+        page_ids = [book['id'] for book in filtered_library]
+        selected = st.session_state.selected_books
+        col1, col2, col3, col4, col5 = st.columns([2, 1, 1, 1, 1])
+        with col1:
+            if page_ids and all(book_id in selected for book_id in page_ids):
+                st.button("Deselect page", on_click=select_books, args=(page_ids, False))
+            else:
+                st.button("Select page", on_click=select_books, args=(page_ids, True))
+        with col2:
+            st.button(f"Clear ({len(selected)})", on_click=clear_selection, disabled=not selected)
+        with col3:
+            if st.button("Mark selected read", key="bulk_read", type="primary", disabled=not selected):
+                set_read_status(list(selected), True)
+                clear_selection()
+                st.rerun()
+        with col4:
+            if st.button("Mark selected unread", key="bulk_unread", disabled=not selected):
+                set_read_status(list(selected), False)
+                clear_selection()
+                st.rerun()
+        with col5:
+            if st.button("Remove selected", key="bulk_remove", disabled=not selected):
+                remove_books(list(selected))
+                clear_selection()
+                st.rerun()
+
+        similar_to = st.session_state.get("similar_to")
+        book = st.session_state.catalog.index.get(similar_to) if similar_to else None
+        if book is not None:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.markdown(f"#### More like {html.escape(book['title'])}")
+            with col2:
+                st.button("Close", key="close_similar", on_click=close_similar)
+            similar = recommend_books([similar_to])
+            if similar:
+                render_cards(similar)
+            else:
+                st.info("No unread books like this one yet.")
+
+        cards_started = time.perf_counter()
         for book in filtered_library:
             
             if 'read' not in book:
                 book['read'] = False
-            if 'id' not in book:
-                book['id'] = str(random.randint(10000, 99999))
                 
             with st.container():
-                card_class = "book-card read-card" if book["read"] else "book-card unread-card"
-                st.markdown(f"""
-                <div class="{card_class}">
-                    <div>
-                        <div class="book-title">{book.get('title', 'No Title')}</div>
-                        <div class="book-meta">by {book.get('author', 'Unknown')} • {book.get('year', 'N/A')} • {book.get('genre', 'Uncategorized')}</div>
-                        <div style="margin-top: 0.75rem;">
-                            <span class="status-badge {'read-badge' if book['read'] else 'unread-badge'}">
-                                { 'Read' if book['read'] else 'Unread' }
-                            </span>
-                        </div>
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
-                col1, col2 = st.columns(2)
+                # Each card keeps its own element here, so its buttons stay under it.
+                render_cards([book])
+                if f"select_{book['id']}" not in st.session_state:
+                    st.session_state[f"select_{book['id']}"] = book['id'] in selected
+                col0, col1, col2, col3 = st.columns([1, 3, 3, 3])
+                with col0:
+                    st.checkbox("Select", key=f"select_{book['id']}", on_change=update_selection, args=(book['id'],),
+                                label_visibility="collapsed")
                 with col1:
                     if st.button(f"{'Mark Unread' if book['read'] else 'Mark Read'}", key=f"toggle_{book['id']}", type="primary"):
                         toggle_read_status(book['id'])
                         st.rerun()
                 with col2:
+                    st.button("Similar", key=f"similar_{book['id']}", on_click=show_similar, args=(book['id'],))
+                with col3:
                     if st.button("Remove", key=f"remove_{book['id']}", type="secondary"):
                         remove_book(book['id'])
+                        st.session_state.selected_books.discard(book['id'])
                         st.rerun()
+        telemetry.record("library cards", "phase", "", time.perf_counter() - cards_started, filtered_library)
 
-with tabs[1]:
+
+def show_add_book():
     st.header("Add a New Book")
     with st.container():
         col1, col2 = st.columns(2)
@@ -597,55 +1043,50 @@ with tabs[1]:
             author = st.text_input("Author", placeholder="Author name")
             year = st.text_input("Year", placeholder="e.g., 2025")
         with col2:
-            genre = st.selectbox("Genre", ["Fiction", "Non-Fiction", "Mystery", "Sci-Fi", "Fantasy", 
-                "Biography", "History", "Self-Help", "Romance", "Horror",
-                "Thriller", "Poetry", "Science", "Technology", "Philosophy", "Other"])
+            genre = st.selectbox("Genre", GENRES)
             read_status = st.radio("Read status", ["Read", "Unread"], horizontal=True)
 
         if st.button("Add to library", type="primary"):
             if add_book(title, author, year, genre, read_status == "Read"):
                 st.success(f"Added '{title}' successfully!")
 
-with tabs[2]:
+    with st.expander("Bulk import from CSV, JSON or Excel"):
+        upload = st.file_uploader("Import file", type=IMPORT_FORMATS)
+        if upload is not None and st.button("Import books", type="primary"):
+            import_status = st.empty()
+            imported, rejects = import_uploaded_books(
+                upload, lambda done, rejected: import_status.text(f"Imported {done} books, rejected {rejected} rows...")
+            )
+            import_status.empty()
+            st.success(f"Imported {imported} books.")
+            if rejects:
+                rejects_csv = io.StringIO()
+                write_rejects(rejects, rejects_csv)
+                st.warning(f"{len(rejects)} rows were rejected.")
+                st.download_button("Download rejected rows", rejects_csv.getvalue(), file_name="rejected_books.csv", mime="text/csv")
+
+
+def show_search():
     st.header("Search for a Book")
     with st.container():
         col1, col2 = st.columns([3, 1], gap="small")
         with col1:
             search_term = st.text_input("Search", placeholder="Enter search term...", label_visibility="collapsed")
         with col2:
-            search_by = st.selectbox("Search by", ["title", "author", "year", "genre"], label_visibility="collapsed")
+            search_by = st.selectbox("Search by", ["all", "title", "author", "year", "genre"], label_visibility="collapsed")
 
         if search_term:
-            results = search_books(search_term, search_by)
+            results = cached_search(search_term, search_by)
             if results:
-                st.subheader(f"{len(results)} Results")
-                for book in results:
-                    # Ensure required fields exist
-                    if 'read' not in book:
-                        book['read'] = False
-                    if 'id' not in book:
-                        book['id'] = str(random.randint(10000, 99999))
-                        
-                    card_class = "book-card read-card" if book["read"] else "book-card unread-card"
-                    st.markdown(f"""
-                    <div class="{card_class}">
-                        <div>
-                            <div class="book-title">{book.get('title', 'No Title')}</div>
-                            <div class="book-meta">by {book.get('author', 'Unknown')} • {book.get('year', 'N/A')} • {book.get('genre', 'Uncategorized')}</div>
-                            <div style="margin-top: 0.75rem;">
-                                <span class="status-badge {'read-badge' if book['read'] else 'unread-badge'}">
-                                    { 'Read' if book['read'] else 'Unread' }
-                                </span>
-                            </div>
-                        </div>
-                    </div>
-                    """, unsafe_allow_html=True)
+                st.subheader(f"Top {len(results)} Results" if len(results) == SEARCH_LIMIT else f"{len(results)} Results")
+                render_cards(results)
             else:
                 st.info("No matching books found.")
         else:
             st.info("Enter a search term to begin.")
 
-with tabs[3]:
+
+def show_insights():
     st.subheader("Reading Insights")
     stats = get_statistics()
     col1, col2, col3 = st.columns(3)
@@ -674,9 +1115,145 @@ with tabs[3]:
         </div>
         """.format(stats["percentage"]), unsafe_allow_html=True)
 
+    if stats["total"]:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown("#### Books by genre")
+            st.bar_chart({"genre": list(stats["genres"]), "books": list(stats["genres"].values())}, x="genre", y="books")
+        with col2:
+            st.markdown("#### Books by decade")
+            st.bar_chart({"decade": [f"{decade}s" for decade in stats["decades"]], "books": list(stats["decades"].values())}, x="decade", y="books")
+        st.markdown("#### Top authors")
+        st.dataframe(
+            {"Author": [author for author, _ in stats["authors"]], "Books": [count for _, count in stats["authors"]]},
+            hide_index=True,
+            use_container_width=True,
+        )
+        if 0 < stats["read"] < stats["total"]:
+            st.markdown("#### Up next from your unread pile")
+            render_cards(recommend_books())
+
+
+def show_performance():
+    st.subheader("Performance")
+    st.caption("Data-layer calls and rerun phases across all sessions since the app started.")
+    st.caption(f"This session's first paint took {st.session_state.first_paint * 1000:.0f} ms.")
+    summary = telemetry.summary()
+    if summary:
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+    else:
+        st.info("Nothing measured yet.")
+    slow_queries = list(telemetry.slow)
+    if slow_queries:
+        st.markdown(f"#### Slow queries (over {telemetry.slow_ms} ms)")
+        st.dataframe(
+            [
+                {
+                    "time": sample["time"], "query": sample["name"], "backend": sample["backend"], "ms": sample["ms"],
+                    "documents": sample["documents"], "plan": (sample.get("plan") or {}).get("stages", ""),
+                    "indexed": (sample.get("plan") or {}).get("indexed"),
+                }
+                for sample in reversed(slow_queries)
+            ],
+            hide_index=True,
+            use_container_width=True,
+        )
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("Prometheus metrics", telemetry.prometheus(), file_name="library_metrics.prom", mime="text/plain")
+    with col2:
+        st.download_button("Recent samples (JSON lines)", telemetry.json_lines(), file_name="library_samples.jsonl",
+                           mime="application/jsonl")
+
+
+st.markdown(
+    """
+    <div class="welcome-banner">
+        <h1 style="font-size: 24px; text-align: center;">Personal Library Manager</h1>
+    </div>
+    """,
+    unsafe_allow_html=True
+)
+
+if 'first_paint' not in st.session_state:
+    # How long a new session waits before it sees the page.
+    st.session_state.first_paint = time.perf_counter() - rerun_started
+    telemetry.record("first paint", "phase", "", st.session_state.first_paint)
+
+if 'mongo_collection' not in st.session_state:
+    st.session_state.mongo_collection = connect_to_mongodb() if STORAGE_BACKEND == "mongodb" else None
+
+if 'library' not in st.session_state:
+    # An unreachable server still gets the MongoDB backend, with its breaker
+    # open; only a missing or invalid connection string means file mode.
+    if st.session_state.mongo_collection is not None:
+        backend_name = "mongodb"
+    else:
+        backend_name = "sqlite" if STORAGE_BACKEND == "sqlite" else "json"
+    with telemetry.measure("storage init", "phase"):
+        st.session_state.backend, st.session_state.catalog, st.session_state.breaker = get_storage(
+            backend_name, st.session_state.mongo_collection
+        )
+    st.session_state.library = st.session_state.catalog.books
+    st.session_state.search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+    backend, catalog = st.session_state.backend, st.session_state.catalog
+    for warning in backend.warnings + ([] if backend is catalog else catalog.warnings):
+        st.warning(warning)
+    if st.session_state.breaker is not None and st.session_state.breaker.outbox.rejected:
+        outbox = st.session_state.breaker.outbox
+        st.warning(
+            f"{outbox.rejected} changes made while {backend.name} was down would have duplicated books stored "
+            f"in the meantime; they were set aside in {outbox.rejects_path}."
+        )
+
+if 'selected_books' not in st.session_state:
+    st.session_state.selected_books = set()
+
+if st.session_state.breaker is not None and not st.session_state.breaker.allow():
+    st.warning(
+        f"{st.session_state.backend.name} is not responding, so the library is served from the local copy. "
+        f"Changes are kept ({st.session_state.breaker.outbox.pending} waiting) and synced once it is back."
+    )
+
+VIEWS = {
+    "📚 Library": ("library", show_library),
+    "+ Add Book": ("add", show_add_book),
+    "🔍 Search": ("search", show_search),
+    "📊 Insights": ("insights", show_insights),
+}
+if SHOW_PERFORMANCE:
+    VIEWS["⏱️ Performance"] = ("performance", show_performance)
+
+if LAZY_START:
+    # Only the chosen view is built, so a rerun never pays for the others.
+    view = st.radio("View", list(VIEWS), horizontal=True, label_visibility="collapsed", key="view")
+    phase, show = VIEWS[view]
+    with telemetry.measure(f"{phase} tab", "phase"):
+        show()
+else:
+    for tab, (phase, show) in zip(st.tabs(list(VIEWS)), VIEWS.values()):
+        with tab, telemetry.measure(f"{phase} tab", "phase"):
+            show()
+
+if isinstance(st.session_state.backend, MongoBackend) and st.session_state.breaker.allow():
+    with st.sidebar.expander("Index diagnostics"):
+        if st.button("Check query plans"):
+            report = check_query_indexes()
+            missed = [row for row in report if not row["indexed"]]
+            if missed:
+                st.warning(f"{len(missed)} of {len(report)} queries are not fully index-backed.")
+            else:
+                st.success(f"All {len(report)} queries use an index.")
+            st.dataframe(report, use_container_width=True)
+
 st.markdown("""
 <div class="footer">
     <p>Personal Library Manager</p>
     <p>made with ❤️ by <a href="https://nihal-khan.vercel.app/">Nihal Khan Ghauri</a></p>
 </div>
 """, unsafe_allow_html=True)
+
+st.session_state.drawn_version = st.session_state.catalog.version
+follow_catalog()
+
+telemetry.record("rerun", "phase", "", time.perf_counter() - rerun_started)
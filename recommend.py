@@ -0,0 +1,163 @@
+"""Similar-book recommendations over the in-memory catalog.
+
+Every book is a row of one float32 matrix: hashed title tokens, hashed
+author tokens, a one-hot genre and the publication year as a point on a
+quarter circle (so nearby years score close to 1). Each block is scaled by
+its weight and the row is unit length, so one matrix-vector product gives
+the cosine similarity of every book to a query. Rows are added, cleared and
+re-flagged in place as the catalog changes, so the matrix is never rebuilt.
+"""
+import math
+import zlib
+
+import numpy as np
+
+from books import GENRES
+from storage import tokenize
+
+
+TITLE_BUCKETS = 128
+AUTHOR_BUCKETS = 32
+YEAR_RANGE = (1500, 2030)
+# Relative pull of each block on the similarity.
+WEIGHTS = {"title": 1.0, "author": 1.2, "genre": 0.8, "year": 0.5}
+
+TITLE_START = 0
+AUTHOR_START = TITLE_START + TITLE_BUCKETS
+GENRE_START = AUTHOR_START + AUTHOR_BUCKETS
+YEAR_START = GENRE_START + len(GENRES) + 1
+FEATURES = YEAR_START + 2
+GENRE_COLUMNS = {genre.lower(): GENRE_START + position for position, genre in enumerate(GENRES)}
+INITIAL_CAPACITY = 1024
+
+
+def hash_tokens(row, tokens, start, buckets, weight):
+    # Signed feature hashing, so colliding tokens cancel out rather than add up.
+    if not tokens:
+        return
+    value = weight / math.sqrt(len(tokens))
+    for token in tokens:
+        digest = zlib.crc32(token.encode("utf-8"))
+        row[start + digest % buckets] += value if digest & 0x80000000 else -value
+
+
+def book_features(book, row=None):
+    """Fills row (or a new vector) with the unit-length features of book."""
+    if row is None:
+        row = np.zeros(FEATURES, dtype=np.float32)
+    else:
+        row[:] = 0
+    hash_tokens(row, tokenize(book.get("title", "")), TITLE_START, TITLE_BUCKETS, WEIGHTS["title"])
+    hash_tokens(row, tokenize(book.get("author", "")), AUTHOR_START, AUTHOR_BUCKETS, WEIGHTS["author"])
+    genre = str(book.get("genre") or "").lower()
+    row[GENRE_COLUMNS.get(genre, YEAR_START - 1)] = WEIGHTS["genre"]
+    try:
+        year = min(max(int(book.get("year")), YEAR_RANGE[0]), YEAR_RANGE[1])
+    except (TypeError, ValueError):
+        year = None
+    if year is not None:
+        angle = (year - YEAR_RANGE[0]) / (YEAR_RANGE[1] - YEAR_RANGE[0]) * math.pi / 2
+        row[YEAR_START] = WEIGHTS["year"] * math.cos(angle)
+        row[YEAR_START + 1] = WEIGHTS["year"] * math.sin(angle)
+    norm = np.linalg.norm(row)
+    if norm:
+        row /= norm
+    return row
+
+
+class SimilarityIndex:
+    """Feature rows for a set of books, with a running sum of the read rows.
+
+    Removed books leave a zeroed row that the next added book reuses. Not
+    thread-safe; the catalog calls it under its lock.
+    """
+
+    def __init__(self, books=()):
+        books = list(books)
+        capacity = max(INITIAL_CAPACITY, len(books))
+        self.matrix = np.zeros((capacity, FEATURES), dtype=np.float32)
+        self.live = np.zeros(capacity, dtype=bool)
+        self.read = np.zeros(capacity, dtype=bool)
+        self.read_sum = np.zeros(FEATURES, dtype=np.float64)
+        self.ids = [None] * capacity
+        self.rows = {}
+        self.free = []
+        self.size = 0
+        for book in books:
+            self.add(book)
+
+    def grow(self):
+        capacity = len(self.ids) * 2
+        for name in ("matrix", "live", "read"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.ids.extend([None] * (capacity - len(self.ids)))
+
+    def add(self, book):
+        if book['id'] in self.rows:
+            self.remove(book['id'])
+        if self.free:
+            row = self.free.pop()
+        else:
+            if self.size == len(self.ids):
+                self.grow()
+            row = self.size
+            self.size += 1
+        book_features(book, self.matrix[row])
+        self.live[row] = True
+        self.read[row] = bool(book.get("read", False))
+        if self.read[row]:
+            self.read_sum += self.matrix[row]
+        self.ids[row] = book['id']
+        self.rows[book['id']] = row
+
+    def remove(self, book_id):
+        row = self.rows.pop(book_id, None)
+        if row is None:
+            return
+        if self.read[row]:
+            self.read_sum -= self.matrix[row]
+        self.matrix[row] = 0
+        self.live[row] = False
+        self.read[row] = False
+        self.ids[row] = None
+        self.free.append(row)
+
+    def set_read(self, book_id, read):
+        row = self.rows.get(book_id)
+        if row is None or self.read[row] == bool(read):
+            return
+        self.read[row] = bool(read)
+        if read:
+            self.read_sum += self.matrix[row]
+        else:
+            self.read_sum -= self.matrix[row]
+
+    def similar(self, book_ids=None, k=10, unread_only=True):
+        """Ids of the k books most similar to book_ids, best first, leaving
+        out book_ids themselves. Without book_ids, the query is the read
+        books as a whole."""
+        size = self.size
+        rows = [self.rows[book_id] for book_id in book_ids or () if book_id in self.rows]
+        if book_ids:
+            if not rows:
+                return []
+            # The mean similarity to several books is the similarity to their
+            # summed rows, so any query is one pass over the matrix.
+            query = self.matrix[rows].sum(axis=0)
+        elif self.read[:size].any():
+            query = self.read_sum.astype(np.float32)
+        else:
+            return []
+        scores = self.matrix[:size] @ query
+        eligible = self.live[:size] & ~self.read[:size] if unread_only else self.live[:size].copy()
+        eligible[rows] = False
+        scores[~eligible] = -np.inf
+        k = min(k, int(eligible.sum()))
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.ids[row] for row in top]
@@ -0,0 +1,1684 @@
+"""Storage backends for the library.
+
+Every backend offers the same operations (load, insert, delete, toggle,
+search, filter/sort, stats, genres, export), so the app picks one through
+configuration instead of branching on the database in every function:
+
+    MongoBackend   a MongoDB collection
+    SqliteBackend  an embedded SQLite database in WAL mode, for single-node
+                   deployments that want indexed queries without a server
+    JsonBackend    the in-memory catalog over library.json and its change
+                   journal; also the fallback when another backend fails
+"""
+import bisect
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from books import (
+    SORT_OPTIONS, BookIdGenerator, book_key, build_filter_query, build_sort_spec, date_added_ms, is_book_id,
+    iter_json_records, migrate_mongo_book_ids, new_book_id, sort_value,
+)
+from export_books import iter_mongo_books
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+SEARCH_FIELDS = {"title": 10, "author": 5, "genre": 2}
+SEARCH_LIMIT = 50
+TOKEN_PATTERN = re.compile(r"\w+")
+TOP_AUTHORS = 10
+RECOMMENDATIONS = 10
+
+LOAD_BATCH_SIZE = 1000
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+DUPLICATES_WARNING = ("Duplicate books keep the unique title/author index from being built; "
+                      "run `python dedupe.py` to review them and `python dedupe.py --merge` to merge them.")
+
+
+class BookRecord:
+    """Compact, slot-based book record shared by every session.
+
+    Supports the dict operations the app uses on books (get, [], in, copy), so
+    records can be used wherever a book dict was used before.
+    """
+
+    __slots__ = ("_id", "id", "title", "author", "year", "genre", "read", "date_added", "key")
+
+    def __init__(self, fields):
+        for key, value in fields.items():
+            if key in self.__slots__:
+                setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def update(self, fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def copy(self):
+        return {key: getattr(self, key) for key in self.__slots__ if hasattr(self, key)}
+
+
+def encode_book(value):
+    if isinstance(value, BookRecord):
+        return value.copy()
+    return str(value)
+
+
+LOAD_PROJECTION = {field: 1 for field in BookRecord.__slots__ if field != "_id"}
+
+
+def record_key(book):
+    # Books stored before keys were kept get theirs computed.
+    return book.get("key") or book_key(book.get("title", ""), book.get("author", ""))
+
+
+class DuplicateBookError(ValueError):
+    """A write was refused because a book with the same title/author key is
+    already stored. books holds the refused books."""
+
+    def __init__(self, message, books=()):
+        super().__init__(message)
+        self.books = list(books)
+
+
+def duplicate_message(book):
+    return f"'{book.get('title')}' by {book.get('author')} is already in the library."
+
+
+def refused_message(refused, total):
+    if len(refused) == 1:
+        return duplicate_message(refused[0])
+    return f"{len(refused)} of {total} books were already in the library."
+
+
+def persisted_copy(book):
+    book_copy = book.copy()
+    if '_id' in book_copy and isinstance(book_copy['_id'], str):
+        del book_copy['_id']
+    if 'read' not in book_copy:
+        book_copy['read'] = False
+    return book_copy
+
+
+def persisted_fingerprint(book_copy):
+    return hash(tuple(sorted(book_copy.items(), key=lambda item: item[0])))
+
+
+def snapshot_library(library):
+    # Fingerprints rather than copies, so tracking changes costs one int per book.
+    return {book['id']: persisted_fingerprint(persisted_copy(book)) for book in library if 'id' in book}
+
+
+def build_statistics(read_books, total_books, genres, decades, authors):
+    percentage_read = (read_books / total_books * 100) if total_books > 0 else 0
+    return {
+        "total": total_books,
+        "read": read_books,
+        "unread": total_books - read_books,
+        "percentage": percentage_read,
+        "genres": genres,
+        "decades": decades,
+        "authors": authors,
+    }
+
+
+class LibraryIndex:
+    """Secondary indexes over the in-memory library for the file/offline mode.
+
+    Books are looked up by id in O(1), filtered through genre and read-status
+    buckets, and listed from orderings that are kept sorted for every sort
+    option, so a filtered page never needs a full re-sort.
+    """
+
+    def __init__(self, books=()):
+        self.by_id = {}
+        self.by_genre = {}
+        self.by_read = {True: set(), False: set()}
+        self.by_key = {}
+        self.orderings = {sort_by: [] for sort_by in SORT_OPTIONS}
+        for book in books:
+            self.add(book)
+
+    @staticmethod
+    def sort_key(book, sort_by):
+        field, _, default = SORT_OPTIONS[sort_by]
+        return (sort_value(book.get(field, default)), book['id'])
+
+    def get(self, book_id):
+        return self.by_id.get(book_id)
+
+    def add(self, book):
+        book_id = book['id']
+        if 'read' not in book:
+            book['read'] = False
+        self.by_id[book_id] = book
+        self.by_genre.setdefault(book.get("genre", "Other"), set()).add(book_id)
+        self.by_read[bool(book["read"])].add(book_id)
+        self.by_key.setdefault(record_key(book), set()).add(book_id)
+        for sort_by, ordering in self.orderings.items():
+            bisect.insort(ordering, self.sort_key(book, sort_by))
+
+    def remove(self, book_id):
+        book = self.by_id.pop(book_id, None)
+        if book is None:
+            return None
+        self.by_genre.get(book.get("genre", "Other"), set()).discard(book_id)
+        self.by_read[bool(book.get("read", False))].discard(book_id)
+        key = record_key(book)
+        ids = self.by_key.get(key, set())
+        ids.discard(book_id)
+        if not ids:
+            self.by_key.pop(key, None)
+        for sort_by, ordering in self.orderings.items():
+            position = bisect.bisect_left(ordering, self.sort_key(book, sort_by))
+            del ordering[position]
+        return book
+
+    def set_read(self, book_id, read):
+        book = self.by_id[book_id]
+        self.by_read[bool(book.get("read", False))].discard(book_id)
+        book["read"] = read
+        self.by_read[bool(read)].add(book_id)
+
+    def genres(self):
+        return sorted(genre for genre, ids in self.by_genre.items() if ids)
+
+    def find_key(self, key):
+        ids = self.by_key.get(key)
+        return next(iter(ids)) if ids else None
+
+    def matching_ids(self, filter_status, filter_genre):
+        buckets = []
+        if filter_status == "Read":
+            buckets.append(self.by_read[True])
+        elif filter_status == "Unread":
+            buckets.append(self.by_read[False])
+        if filter_genre != "All":
+            buckets.append(self.by_genre.get(filter_genre, set()))
+        if not buckets:
+            return None
+        buckets.sort(key=len)
+        return buckets[0].intersection(*buckets[1:])
+
+    def count(self, filter_status, filter_genre):
+        ids = self.matching_ids(filter_status, filter_genre)
+        return len(self.by_id) if ids is None else len(ids)
+
+    def page(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        ids = self.matching_ids(filter_status, filter_genre)
+        descending = SORT_OPTIONS[sort_by][1] < 0
+        if ids is not None and len(ids) * 8 < len(self.by_id):
+            # A selective filter is cheaper to sort directly than to find in the full ordering.
+            keys = sorted((self.sort_key(self.by_id[book_id], sort_by) for book_id in ids), reverse=descending)
+        else:
+            ordering = self.orderings[sort_by]
+            keys = reversed(ordering) if descending else iter(ordering)
+            if ids is not None:
+                keys = (key for key in keys if key[1] in ids)
+        start = (page - 1) * page_size if page_size is not None else 0
+        stop = start + page_size if page_size is not None else None
+        return [self.by_id[book_id] for _, book_id in itertools.islice(keys, start, stop)]
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def search_terms(book):
+    # Every "field:word" of the searchable fields. Stored with each MongoDB
+    # document, so a word prefix is an anchored regex over an index.
+    return sorted({f"{field}:{token}" for field in SEARCH_FIELDS for token in tokenize(book.get(field) or "")})
+
+
+def mongo_document(book):
+    document = book.copy()
+    document["search_terms"] = search_terms(book)
+    return document
+
+
+class SearchResults(list):
+    """Ranked search results. complete is set when they are every book that
+    matches the term by the rules of matches_term (whole words, then a
+    prefix), so a longer term can be answered by filtering them."""
+
+    complete = False
+
+
+def matches_term(book, tokens, search_by):
+    fields = SEARCH_FIELDS if search_by == "all" else [search_by]
+    words = set()
+    for field in fields:
+        words.update(tokenize(book.get(field, "")))
+    *whole, last = tokens
+    return all(token in words for token in whole) and any(word.startswith(last) for word in words)
+
+
+class SearchIndex:
+    """Inverted index over title, author and genre for the file/in-memory mode.
+
+    Every query token except the last must match a whole word; the last one is
+    treated as a prefix so results keep up while the user is still typing.
+    """
+
+    def __init__(self, books=()):
+        self.books = {}
+        self.postings = {}
+        self.terms = []
+        self.years = {}
+        for book in books:
+            self.add(book)
+
+    def add(self, book):
+        book_id = book['id']
+        self.books[book_id] = book
+        for field in SEARCH_FIELDS:
+            for token in tokenize(book.get(field, "")):
+                if token not in self.postings:
+                    self.postings[token] = {}
+                    bisect.insort(self.terms, token)
+                fields = self.postings[token].setdefault(book_id, {})
+                fields[field] = fields.get(field, 0) + 1
+        self.years.setdefault(str(book.get("year", "")), set()).add(book_id)
+
+    def remove(self, book_id):
+        book = self.books.pop(book_id, None)
+        if book is None:
+            return
+        for field in SEARCH_FIELDS:
+            for token in set(tokenize(book.get(field, ""))):
+                postings = self.postings.get(token)
+                if postings is None:
+                    continue
+                postings.pop(book_id, None)
+                if not postings:
+                    del self.postings[token]
+                    del self.terms[bisect.bisect_left(self.terms, token)]
+        self.years.get(str(book.get("year", "")), set()).discard(book_id)
+
+    def expand(self, token, prefix):
+        if not prefix:
+            return [token] if token in self.postings else []
+        # Every term with the prefix: they sort between token and token + the highest code point.
+        start = bisect.bisect_left(self.terms, token)
+        stop = bisect.bisect_left(self.terms, token + "\U0010ffff", start)
+        return self.terms[start:stop]
+
+    def search(self, search_term, search_by="all", limit=SEARCH_LIMIT):
+        if search_by == "year":
+            ids = self.years.get(search_term.strip(), set())
+            return [self.books[book_id] for book_id in sorted(ids)][:limit]
+
+        fields = SEARCH_FIELDS if search_by == "all" else {search_by: SEARCH_FIELDS[search_by]}
+        tokens = tokenize(search_term)
+        if not tokens:
+            return []
+        results = SearchResults()
+        results.complete = True
+        total = max(len(self.books), 1)
+        scores = None
+        for position, token in enumerate(tokens):
+            token_scores = {}
+            for term in self.expand(token, prefix=position == len(tokens) - 1):
+                postings = self.postings[term]
+                idf = math.log(1 + total / len(postings))
+                boost = 1.0 if term == token else 0.5
+                for book_id, counts in postings.items():
+                    if scores is not None and book_id not in scores:
+                        # Already ruled out by an earlier token.
+                        continue
+                    weight = sum(fields[field] * count for field, count in counts.items() if field in fields)
+                    if weight:
+                        score = weight * idf * boost
+                        token_scores[book_id] = max(token_scores.get(book_id, 0), score)
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {book_id: scores[book_id] + score for book_id, score in token_scores.items() if book_id in scores}
+            if not scores:
+                return results
+        ranked = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        results.extend(self.books[book_id] for book_id, _ in ranked)
+        results.complete = len(scores) <= limit
+        return results
+
+
+class FileLock:
+    """A lock for a file shared by several processes (app replicas, api.py,
+    bulk_import.py --journal): a thread lock for this process plus an flock
+    on path for the others. Where fcntl is missing (Windows) it only covers
+    this process."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            try:
+                self.file = open(self.path, "a")
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            except BaseException:
+                self.release_file()
+                self.lock.release()
+                raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release_file()
+        self.lock.release()
+
+    def release_file(self):
+        # Closing the file drops the flock.
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def append_changes(path, entries):
+    # One line per change, synced before returning; the format of the journal
+    # and of the outbox.
+    with open(path, "a") as file:
+        file.write("".join(json.dumps(entry, default=encode_book) + "\n" for entry in entries))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def parse_changes(lines):
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            # A torn line from a crash mid-append; the entries around it are intact.
+            continue
+    return entries
+
+
+def read_changes(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return parse_changes(file)
+
+
+class StorageBackend:
+    """Operations every storage backend provides.
+
+    Writes return once the change is durable in the backend. toggle returns
+    the new read status, or None when the book does not exist; delete returns
+    whether a book was removed. set_read_many and delete_many change many
+    books in one operation and return how many books they matched. insert
+    and insert_many raise DuplicateBookError for books whose title/author
+    key (books.book_key) is already stored; insert_many writes the other
+    books first, and the error lists the refused ones.
+    """
+
+    name = "storage"
+
+    def __init__(self):
+        # Problems found while opening the backend, shown once per session.
+        self.warnings = []
+
+    def load(self):
+        raise NotImplementedError
+
+    def insert(self, book):
+        raise NotImplementedError
+
+    def insert_many(self, books):
+        raise NotImplementedError
+
+    def delete(self, book_id):
+        raise NotImplementedError
+
+    def toggle(self, book_id):
+        raise NotImplementedError
+
+    def set_read_many(self, book_ids, read):
+        raise NotImplementedError
+
+    def delete_many(self, book_ids):
+        raise NotImplementedError
+
+    def search(self, search_term, search_by, limit=SEARCH_LIMIT):
+        raise NotImplementedError
+
+    def count(self, filter_status, filter_genre):
+        raise NotImplementedError
+
+    def page(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        raise NotImplementedError
+
+    def statistics(self):
+        raise NotImplementedError
+
+    def genres(self):
+        return sorted(self.statistics()["genres"])
+
+    def explain(self, method, args):
+        """Summarizes the query plan of a read as {"stages", "indexed"}, or
+        None where there is no plan to show."""
+        return None
+
+    def save(self, library):
+        raise NotImplementedError
+
+    def iter_books(self, filter_status, filter_genre, sort_by):
+        raise NotImplementedError
+
+    def ping(self):
+        raise NotImplementedError
+
+    def apply_changes(self, entries):
+        """Applies journal-format changes ("add", "remove", "update") in one
+        batch. Adds are upserts and updates set absolute values, so applying
+        the same changes twice is harmless.
+
+        Returns the entries that were skipped because they would give a
+        stored book's title/author key to a second book; the rest still
+        apply, in order.
+        """
+        raise NotImplementedError
+
+
+class JsonBackend(StorageBackend):
+    """The library, its indexes and its version counter, shared by every session.
+
+    Sessions reference this one copy instead of each loading their own, and a
+    change made in one session is visible to all of them. The lock guards the
+    indexes, which are updated in place, and the recommendation matrix
+    (recommend.py), which is kept in step with them once built.
+
+    Changes are appended to a journal and folded into the library.json
+    snapshot once the journal grows past JOURNAL_COMPACT_BYTES. When another
+    backend is primary, the catalog is built from its books and only mirrors
+    its changes in memory (remember, forget, mark_read); the journal is then
+    used only for writes the primary backend could not take.
+    """
+
+    name = "library file"
+
+    def __init__(self, library_file, journal_file, books=None):
+        super().__init__()
+        self.library_file = library_file
+        self.journal_file = journal_file
+        # Serializes journal appends, snapshot writes and the reads that need
+        # both files to agree, across sessions and processes.
+        self.file_lock = FileLock(f"{journal_file}.lock")
+        self.lock = threading.RLock()
+        # file_position() as of load(), where a file watcher picks up from.
+        self.loaded_position = None
+        self.books = self.load() if books is None else books
+        self.index = LibraryIndex(self.books)
+        self.search_index = SearchIndex(self.books)
+        # The recommendation matrix, built the first time it is asked for.
+        self.similarity = None
+        self.version = 0
+
+    def load(self):
+        with self.file_lock:
+            library = self.read_snapshot()
+            migrated = False
+            for book in library:
+                if 'read' not in book:
+                    book['read'] = False
+                if 'id' not in book:
+                    book['id'] = new_book_id()
+                    migrated = True
+            library = self.replay_journal(library)
+            # Ids from the old random scheme are replaced with time-ordered ones,
+            # stamped with the day the book was added.
+            generator = BookIdGenerator()
+            for book in library:
+                if not is_book_id(book['id']):
+                    book['id'] = generator.next_id(date_added_ms(book))
+                    migrated = True
+            if migrated:
+                # Persist assigned ids so they stay stable and journal entries refer to them.
+                self.write_snapshot(library)
+            self.loaded_position = self.file_position()
+        return library
+
+    def file_position(self):
+        # The snapshot's modification time and the journal's size.
+        try:
+            snapshot_mtime = os.stat(self.library_file).st_mtime_ns
+        except FileNotFoundError:
+            snapshot_mtime = None
+        try:
+            size = os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            size = 0
+        return snapshot_mtime, size
+
+    def read_snapshot(self):
+        if not os.path.exists(self.library_file):
+            return []
+        try:
+            return [BookRecord(book) for book in iter_json_records(self.library_file)]
+        except json.JSONDecodeError:
+            corrupt_file = f"{self.library_file}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+            os.replace(self.library_file, corrupt_file)
+            self.warnings.append(f"Error loading library file. It was kept as {corrupt_file}; loading the change log only.")
+            return []
+
+    def replay_journal(self, library):
+        if not os.path.exists(self.journal_file):
+            return library
+        books = {book['id']: book for book in library}
+        for entry in read_changes(self.journal_file):
+            if entry["op"] == "add":
+                books[entry["book"]["id"]] = BookRecord(entry["book"])
+            elif entry["op"] == "remove":
+                books.pop(entry["id"], None)
+            elif entry["op"] == "update" and entry["id"] in books:
+                books[entry["id"]].update(entry["fields"])
+        return list(books.values())
+
+    def write_snapshot(self, library):
+        temp_file = f"{self.library_file}.tmp"
+        with open(temp_file, "w") as file:
+            json.dump(library, file, indent=4, default=encode_book)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.library_file)
+        # The snapshot now contains every logged change.
+        open(self.journal_file, "w").close()
+
+    def log_changes(self, entries):
+        # The caller holds file_lock, taken before self.lock, from its change
+        # in memory through this append, so the journal gets the changes in
+        # the order the catalog made them.
+        append_changes(self.journal_file, entries)
+        if os.path.getsize(self.journal_file) > JOURNAL_COMPACT_BYTES:
+            # Compact from disk rather than memory, so changes logged by
+            # other processes are folded in as well.
+            self.write_snapshot(self.replay_journal(self.read_snapshot()))
+        return True
+
+    def remember(self, book):
+        # Replaces a held book with the same id: the change feed can bring a
+        # write back before the session that made it gets to remember it.
+        with self.lock:
+            if self.index.get(book['id']) is not None:
+                self.forget(book['id'])
+            self.books.append(book)
+            self.index.add(book)
+            self.search_index.add(book)
+            if self.similarity is not None:
+                self.similarity.add(book)
+
+    def forget(self, book_id):
+        with self.lock:
+            book = self.index.remove(book_id)
+            if book is None:
+                return None
+            self.books.remove(book)
+            self.search_index.remove(book_id)
+            if self.similarity is not None:
+                self.similarity.remove(book_id)
+        return book
+
+    def mark_read(self, book_id, read):
+        with self.lock:
+            book = self.index.get(book_id)
+            if book is not None:
+                self.index.set_read(book_id, read)
+                if self.similarity is not None:
+                    self.similarity.set_read(book_id, read)
+        return book
+
+    def merge_changes(self, entries):
+        """Applies journal-format changes made outside this process to the
+        in-memory catalog only. Changes it already holds are skipped, so its
+        own writes coming back through a change feed cost nothing. Bumps the
+        version when anything changed and returns the number of changes."""
+        changed = 0
+        with self.lock:
+            for entry in entries:
+                if entry["op"] == "add":
+                    book = BookRecord(entry["book"].copy())
+                    if 'read' not in book:
+                        book['read'] = False
+                    current = self.index.get(book['id'])
+                    if current is not None:
+                        if persisted_copy(current) == persisted_copy(book):
+                            continue
+                    self.remember(book)
+                elif entry["op"] == "remove":
+                    if self.forget(entry["id"]) is None:
+                        continue
+                elif entry["op"] == "update":
+                    current = self.index.get(entry["id"])
+                    fields = entry["fields"]
+                    if current is None or all(current.get(key) == value for key, value in fields.items()):
+                        continue
+                    if set(fields) == {"read"}:
+                        self.mark_read(entry["id"], fields["read"])
+                    else:
+                        book = BookRecord(current.copy())
+                        book.update(fields)
+                        self.remember(book)
+                changed += 1
+            if changed:
+                self.version += 1
+        return changed
+
+    def merge_library(self, library):
+        # Brings the catalog in line with a full listing, touching only the books that differ.
+        with self.lock:
+            held = set(self.index.by_id)
+        listed = {book['id'] for book in library}
+        return self.merge_changes(
+            [{"op": "add", "book": book} for book in library] + [{"op": "remove", "id": book_id} for book_id in held - listed]
+        )
+
+    def duplicate_of(self, book):
+        """The id of a held book with the same title/author key, or None."""
+        with self.lock:
+            return self.index.find_key(record_key(book))
+
+    def insert(self, book):
+        with self.file_lock, self.lock:
+            if self.duplicate_of(book) is not None:
+                raise DuplicateBookError(duplicate_message(book), [book])
+            self.remember(book)
+            self.log_changes([{"op": "add", "book": book}])
+
+    def insert_many(self, books):
+        accepted = []
+        refused = []
+        with self.file_lock, self.lock:
+            keys = set()
+            for book in books:
+                key = record_key(book)
+                if key in keys or self.index.find_key(key) is not None:
+                    refused.append(book)
+                    continue
+                keys.add(key)
+                accepted.append(book)
+            for book in accepted:
+                self.remember(book)
+            if accepted:
+                self.log_changes([{"op": "add", "book": book} for book in accepted])
+        if refused:
+            raise DuplicateBookError(refused_message(refused, len(books)), refused)
+
+    def delete(self, book_id):
+        with self.file_lock, self.lock:
+            if self.forget(book_id) is None:
+                return False
+            self.log_changes([{"op": "remove", "id": book_id}])
+        return True
+
+    def toggle(self, book_id):
+        with self.file_lock, self.lock:
+            book = self.index.get(book_id)
+            if book is None:
+                return None
+            read = not book.get("read", False)
+            self.mark_read(book_id, read)
+            self.log_changes([{"op": "update", "id": book_id, "fields": {"read": read}}])
+        return read
+
+    def set_read_many(self, book_ids, read):
+        with self.file_lock, self.lock:
+            changed = [book_id for book_id in book_ids if self.mark_read(book_id, read) is not None]
+            if changed:
+                self.log_changes([{"op": "update", "id": book_id, "fields": {"read": read}} for book_id in changed])
+        return len(changed)
+
+    def delete_many(self, book_ids):
+        with self.file_lock, self.lock:
+            removed = [book_id for book_id in book_ids if self.forget(book_id) is not None]
+            if removed:
+                self.log_changes([{"op": "remove", "id": book_id} for book_id in removed])
+        return len(removed)
+
+    def search(self, search_term, search_by, limit=SEARCH_LIMIT):
+        with self.lock:
+            return self.search_index.search(search_term, search_by, limit)
+
+    def count(self, filter_status, filter_genre):
+        with self.lock:
+            return self.index.count(filter_status, filter_genre)
+
+    def page(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        with self.lock:
+            return self.index.page(filter_status, filter_genre, sort_by, page, page_size)
+
+    def statistics(self):
+        total_books = 0
+        read_books = 0
+        genres = Counter()
+        decades = Counter()
+        authors = Counter()
+        with self.lock:
+            books = list(self.books)
+        for book in books:
+            total_books += 1
+            if book.get("read", False):
+                read_books += 1
+            genres[book.get("genre", "Other")] += 1
+            year = book.get("year")
+            if isinstance(year, int):
+                decades[year - year % 10] += 1
+            if book.get("author"):
+                authors[book["author"]] += 1
+        top_authors = sorted(authors.items(), key=lambda item: (-item[1], item[0]))[:TOP_AUTHORS]
+        return build_statistics(read_books, total_books, dict(sorted(genres.items())), dict(sorted(decades.items())), top_authors)
+
+    def genres(self):
+        with self.lock:
+            return self.index.genres()
+
+    def similar(self, book_ids=None, k=RECOMMENDATIONS):
+        """The k unread books most like book_ids, best first, or most like the
+        read books when none are given."""
+        with self.lock:
+            if self.similarity is None:
+                from recommend import SimilarityIndex
+                self.similarity = SimilarityIndex(self.books)
+            return [self.index.get(book_id) for book_id in self.similarity.similar(book_ids, k)]
+
+    def save(self, library):
+        with self.file_lock:
+            self.write_snapshot(library)
+        return 1
+
+    def iter_books(self, filter_status, filter_genre, sort_by):
+        books = self.page(filter_status, filter_genre, sort_by)
+        return (book.copy() for book in books)
+
+    def apply_changes(self, entries):
+        with self.file_lock, self.lock:
+            self.merge_changes(entries)
+            self.log_changes(entries)
+        return []
+
+
+STATS_PIPELINE = [
+    {"$facet": {
+        "read": [
+            {"$group": {"_id": {"$eq": ["$read", True]}, "count": {"$sum": 1}}},
+        ],
+        "genres": [
+            {"$group": {"_id": "$genre", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+        ],
+        "decades": [
+            {"$match": {"year": {"$type": "number"}}},
+            {"$group": {"_id": {"$subtract": ["$year", {"$mod": ["$year", 10]}]}, "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+        ],
+        "authors": [
+            {"$group": {"_id": "$author", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}},
+            {"$limit": TOP_AUTHORS},
+        ],
+    }}
+]
+
+
+def build_index_specs():
+    specs = [
+        ([("id", 1)], {"unique": True, "name": "id_unique"}),
+        # Books stored before keys were kept have none until dedupe.py --merge fills them in.
+        ([("key", 1)], {"unique": True, "name": "key_unique", "partialFilterExpression": {"key": {"$type": "string"}}}),
+        ([(field, "text") for field in SEARCH_FIELDS], {"name": "book_text", "weights": SEARCH_FIELDS}),
+        ([("search_terms", 1)], {"name": "search_terms"}),
+    ]
+    for sort_by in SORT_OPTIONS:
+        for prefix in ([], [("read", 1)], [("genre", 1)], [("read", 1), ("genre", 1)]):
+            keys = prefix + build_sort_spec(sort_by)
+            if keys != build_sort_spec("Added"):
+                # the unique id index already serves the unfiltered "Added" sort
+                specs.append((keys, {}))
+    return specs
+
+
+def backfill_search_terms(collection, batch_size=LOAD_BATCH_SIZE):
+    """Stores the search terms of every document written without them (by
+    an older version, or another tool). Returns the number updated."""
+    from pymongo import UpdateOne
+
+    cursor = collection.find({"search_terms": {"$exists": False}}, list(SEARCH_FIELDS)).batch_size(batch_size)
+    operations = []
+    updated = 0
+    for doc in cursor:
+        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"search_terms": search_terms(doc)}}))
+        if len(operations) >= batch_size:
+            updated += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        updated += collection.bulk_write(operations, ordered=False).modified_count
+    return updated
+
+
+def plan_stages(plan):
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        if "inputStages" in plan:
+            for child in plan["inputStages"]:
+                stages.extend(plan_stages(child))
+            break
+        plan = plan.get("inputStage")
+    return stages
+
+
+def explain_query(cursor):
+    planner = cursor.explain().get("queryPlanner", {})
+    winning = planner.get("winningPlan", {})
+    winning = winning.get("queryPlan", winning)
+    stages = plan_stages(winning)
+    return {
+        "stages": " → ".join(str(stage) for stage in reversed(stages)),
+        "indexed": "COLLSCAN" not in stages and "SORT" not in stages,
+    }
+
+
+class MongoBackend(StorageBackend):
+    """Books in a MongoDB collection.
+
+    Keeps a fingerprint of every book as last written, so save only sends
+    the books that changed.
+    """
+
+    name = "MongoDB"
+
+    def __init__(self, collection):
+        super().__init__()
+        self.collection = collection
+        self.persisted = {}
+
+    def prepare(self):
+        # create_index is a no-op for indexes that already exist. Ids are
+        # migrated first so the unique index can be built.
+        from pymongo.errors import OperationFailure
+
+        failures = []
+        try:
+            migrate_mongo_book_ids(self.collection)
+        except Exception as e:
+            failures.append(f"id migration: {e}")
+        try:
+            backfill_search_terms(self.collection)
+        except Exception as e:
+            failures.append(f"search terms: {e}")
+        for keys, options in build_index_specs():
+            try:
+                self.collection.create_index(keys, **options)
+            except OperationFailure as e:
+                if e.code == 11000:
+                    self.warnings.append(DUPLICATES_WARNING)
+                else:
+                    failures.append(f"{keys}: {e}")
+        if failures:
+            self.warnings.append("Some MongoDB indexes could not be created: " + "; ".join(failures))
+        return failures
+
+    def remember(self, book):
+        self.persisted[book['id']] = persisted_fingerprint(persisted_copy(book))
+
+    def load(self):
+        cursor = self.collection.find({}, LOAD_PROJECTION, batch_size=LOAD_BATCH_SIZE)
+        library = []
+        for doc in cursor:
+            if 'read' not in doc:
+                doc['read'] = False
+            if 'id' not in doc:
+                # Inserted without an id since startup; assign one and keep it.
+                doc['id'] = new_book_id()
+                self.collection.update_one({"_id": doc['_id']}, {"$set": {"id": doc['id']}})
+            doc['_id'] = str(doc['_id'])
+            library.append(BookRecord(doc))
+        self.persisted = snapshot_library(library)
+        return library
+
+    def insert(self, book):
+        from pymongo.errors import DuplicateKeyError
+
+        try:
+            result = self.collection.insert_one(mongo_document(book))
+        except DuplicateKeyError as e:
+            raise DuplicateBookError(duplicate_message(book), [book]) from e
+        book['_id'] = str(result.inserted_id)
+        self.remember(book)
+
+    def insert_many(self, books):
+        from pymongo.errors import BulkWriteError
+
+        # insert_many gives the documents it is handed their _id, so they are
+        # copies; unordered, so one duplicate does not hold back the rest.
+        documents = [mongo_document(book) for book in books]
+        failed = set()
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if not errors or any(error.get("code") != 11000 for error in errors):
+                raise
+            failed = {error["index"] for error in errors}
+        for position, (book, document) in enumerate(zip(books, documents)):
+            if position not in failed:
+                book['_id'] = str(document['_id'])
+                self.remember(book)
+        if failed:
+            refused = [books[position] for position in sorted(failed)]
+            raise DuplicateBookError(refused_message(refused, len(books)), refused)
+
+    def delete(self, book_id):
+        deleted = self.collection.delete_one({"id": book_id}).deleted_count
+        self.persisted.pop(book_id, None)
+        return deleted > 0
+
+    def toggle(self, book_id):
+        from pymongo import ReturnDocument
+
+        # A pipeline update flips the stored value server-side, so concurrent
+        # toggles cannot overwrite each other.
+        book = self.collection.find_one_and_update(
+            {"id": book_id},
+            [{"$set": {"read": {"$not": [{"$ifNull": ["$read", False]}]}}}],
+            LOAD_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
+        if not book:
+            return None
+        book['_id'] = str(book['_id'])
+        self.remember(book)
+        return book['read']
+
+    def set_read_many(self, book_ids, read):
+        matched = self.collection.update_many({"id": {"$in": list(book_ids)}}, {"$set": {"read": read}}).matched_count
+        for book_id in book_ids:
+            self.persisted.pop(book_id, None)
+        return matched
+
+    def delete_many(self, book_ids):
+        deleted = self.collection.delete_many({"id": {"$in": list(book_ids)}}).deleted_count
+        for book_id in book_ids:
+            self.persisted.pop(book_id, None)
+        return deleted
+
+    @staticmethod
+    def clean(books):
+        for book in books:
+            book['_id'] = str(book['_id'])
+            book.pop('score', None)
+            # Ensure required fields exist
+            if 'read' not in book:
+                book['read'] = False
+        return books
+
+    def search_cursor(self, search_term, search_by, limit=SEARCH_LIMIT):
+        # None when the term cannot match anything. As in matches_term, every
+        # word but the last must appear whole and the last may be a prefix:
+        # $text requires the quoted words and ranks the results, prefix_query
+        # holds them to whole stored words and completes the last one.
+        if search_by == "year":
+            if not search_term.isdigit():
+                return None
+            return self.collection.find({"year": int(search_term)}, LOAD_PROJECTION).limit(limit)
+        query = self.prefix_query(search_term, search_by)
+        if query is None:
+            return None
+        whole = tokenize(search_term)[:-1]
+        if not whole:
+            return self.collection.find(query, LOAD_PROJECTION).limit(limit)
+        query["$text"] = {"$search": " ".join(f'"{token}"' for token in whole)}
+        return (self.collection.find(query, {**LOAD_PROJECTION, "score": {"$meta": "textScore"}})
+                .sort([("score", {"$meta": "textScore"})])
+                .limit(limit))
+
+    def search(self, search_term, search_by, limit=SEARCH_LIMIT):
+        cursor = self.search_cursor(search_term, search_by, limit)
+        if cursor is None:
+            return []
+        results = list(cursor)
+        if not results and len(tokenize(search_term)) > 1:
+            # $text drops stop words, so a phrase such as "the" alone finds
+            # nothing; prefix_query by itself still follows matches_term.
+            results = list(self.collection.find(self.prefix_query(search_term, search_by), LOAD_PROJECTION)
+                           .limit(limit))
+        return self.clean(results)
+
+    @staticmethod
+    def prefix_query(search_term, search_by):
+        # Every word but the last matches a whole stored term, the last one a
+        # prefix: case-sensitive and anchored, so the search_terms index
+        # bounds the scan. None when the term has no words.
+        tokens = tokenize(search_term)
+        if not tokens:
+            return None
+        fields = list(SEARCH_FIELDS) if search_by == "all" else [search_by]
+        *whole, last = tokens
+        clauses = [{"search_terms": {"$in": [f"{field}:{token}" for field in fields]}} for token in whole]
+        clauses.append({"$or": [{"search_terms": {"$regex": "^" + re.escape(f"{field}:{last}")}} for field in fields]})
+        return {"$and": clauses}
+
+    def count(self, filter_status, filter_genre):
+        return self.collection.count_documents(build_filter_query(filter_status, filter_genre))
+
+    def page_cursor(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        query = build_filter_query(filter_status, filter_genre)
+        cursor = self.collection.find(query, LOAD_PROJECTION).sort(build_sort_spec(sort_by))
+        if page_size is not None:
+            cursor = cursor.skip((page - 1) * page_size).limit(page_size)
+        return cursor
+
+    def page(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        return self.clean(list(self.page_cursor(filter_status, filter_genre, sort_by, page, page_size)))
+
+    def explain(self, method, args):
+        if method == "page":
+            cursor = self.page_cursor(*args)
+        elif method == "count":
+            cursor = self.collection.find(build_filter_query(*args), {"_id": 0, "read": 1})
+        elif method == "search":
+            cursor = self.search_cursor(*args)
+        else:
+            cursor = None
+        return None if cursor is None else explain_query(cursor)
+
+    def statistics(self):
+        facets = next(self.collection.aggregate(STATS_PIPELINE))
+        read_counts = {doc["_id"]: doc["count"] for doc in facets["read"]}
+        return build_statistics(
+            read_counts.get(True, 0),
+            sum(read_counts.values()),
+            {doc["_id"]: doc["count"] for doc in facets["genres"] if doc["_id"] is not None},
+            {int(doc["_id"]): doc["count"] for doc in facets["decades"]},
+            [(doc["_id"], doc["count"]) for doc in facets["authors"] if doc["_id"] is not None],
+        )
+
+    def genres(self):
+        # A distinct scan over the genre-prefixed indexes, far cheaper than the statistics.
+        return sorted(genre for genre in self.collection.distinct("genre") if genre is not None)
+
+    def save(self, library):
+        from pymongo import DeleteOne, ReplaceOne
+
+        current = {}
+        operations = []
+        for book in library:
+            if 'id' not in book:
+                book['id'] = new_book_id()
+            book_copy = persisted_copy(book)
+            current[book['id']] = persisted_fingerprint(book_copy)
+            if self.persisted.get(book['id']) != current[book['id']]:
+                operations.append(ReplaceOne({"id": book['id']}, mongo_document(book_copy), upsert=True))
+        for book_id in self.persisted:
+            if book_id not in current:
+                operations.append(DeleteOne({"id": book_id}))
+
+        if operations:
+            self.collection.bulk_write(operations, ordered=True)
+        self.persisted = current
+        return len(operations)
+
+    def iter_books(self, filter_status, filter_genre, sort_by):
+        return iter_mongo_books(self.collection, filter_status, filter_genre, sort_by)
+
+    def ping(self):
+        self.collection.database.client.admin.command("ping")
+
+    def operation_time(self):
+        # The cluster time, for a change stream to start from; None on a
+        # standalone server, which has no change streams.
+        return self.collection.database.command("ping").get("operationTime")
+
+    def apply_changes(self, entries):
+        from pymongo import DeleteOne, ReplaceOne, UpdateOne
+        from pymongo.errors import BulkWriteError
+
+        entries = [entry for entry in entries if entry["op"] in ("add", "remove", "update")]
+        operations = []
+        retokenize = False
+        for entry in entries:
+            if entry["op"] == "add":
+                book_copy = persisted_copy(entry["book"])
+                operations.append(ReplaceOne({"id": book_copy['id']}, mongo_document(book_copy), upsert=True))
+                self.persisted[book_copy['id']] = persisted_fingerprint(book_copy)
+            elif entry["op"] == "remove":
+                operations.append(DeleteOne({"id": entry["id"]}))
+                self.persisted.pop(entry["id"], None)
+            elif entry["op"] == "update":
+                update = {"$set": entry["fields"]}
+                if SEARCH_FIELDS.keys() & entry["fields"].keys():
+                    # Stale now; filled in again once the batch is written.
+                    update["$unset"] = {"search_terms": ""}
+                    retokenize = True
+                operations.append(UpdateOne({"id": entry["id"]}, update))
+                self.persisted.pop(entry["id"], None)
+        rejected = []
+        start = 0
+        while start < len(operations):
+            try:
+                self.collection.bulk_write(operations[start:], ordered=True)
+                break
+            except BulkWriteError as e:
+                # An ordered bulk write stops at the first error: set that
+                # entry aside and carry on with the ones after it.
+                error = e.details["writeErrors"][0]
+                if error.get("code") != 11000:
+                    raise
+                failed = start + error["index"]
+                entry = entries[failed]
+                rejected.append(entry)
+                self.persisted.pop(entry["book"]["id"] if entry["op"] == "add" else entry["id"], None)
+                start = failed + 1
+        if retokenize:
+            backfill_search_terms(self.collection)
+        return rejected
+
+    def check_indexes(self, genres, page_size):
+        report = []
+        for filter_status in ["All", "Read", "Unread"]:
+            for filter_genre in ["All"] + genres:
+                for sort_by in SORT_OPTIONS:
+                    query = build_filter_query(filter_status, filter_genre)
+                    cursor = self.collection.find(query).sort(build_sort_spec(sort_by)).limit(page_size)
+                    report.append({"query": f"{filter_status} / {filter_genre} / {sort_by}", **explain_query(cursor)})
+        report.append({"query": "lookup by id", **explain_query(self.collection.find({"id": "0"}).limit(1))})
+        report.append({"query": "count read", **explain_query(self.collection.find({"read": True}, {"_id": 0, "read": 1}))})
+        return report
+
+
+BOOK_COLUMNS = ["id", "title", "author", "year", "genre", "read", "date_added", "key"]
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    year INTEGER,
+    genre TEXT NOT NULL DEFAULT 'Other',
+    read INTEGER NOT NULL DEFAULT 0,
+    date_added TEXT,
+    key TEXT
+);
+CREATE TABLE IF NOT EXISTS book_changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS book_changes_insert AFTER INSERT ON books BEGIN
+    INSERT INTO book_changes (id) VALUES (new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS book_changes_update AFTER UPDATE ON books BEGIN
+    INSERT INTO book_changes (id) VALUES (new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS book_changes_delete AFTER DELETE ON books BEGIN
+    INSERT INTO book_changes (id) VALUES (old.id);
+END;
+"""
+
+SQLITE_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, author, genre, content='books', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.rowid, new.title, new.author, new.genre);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, author, genre) VALUES ('delete', old.rowid, old.title, old.author, old.genre);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, genre ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, title, author, genre) VALUES ('delete', old.rowid, old.title, old.author, old.genre);
+    INSERT INTO books_fts(rowid, title, author, genre) VALUES (new.rowid, new.title, new.author, new.genre);
+END;
+"""
+
+
+def sqlite_index_columns():
+    # The same filter-prefix + sort-key indexes as on MongoDB, with the id as
+    # the tiebreaker. Every column of a sort runs in one direction, so each
+    # index serves both ascending and descending pages.
+    for field, _, _ in SORT_OPTIONS.values():
+        for prefix in ([], ["read"], ["genre"], ["read", "genre"]):
+            columns = prefix + ([field] if field == "id" else [field, "id"])
+            if columns != ["id"]:
+                yield columns
+
+
+def sqlite_where(filter_status, filter_genre):
+    clauses = []
+    params = []
+    for column, value in build_filter_query(filter_status, filter_genre).items():
+        clauses.append(f"{column} = ?")
+        params.append(int(value) if isinstance(value, bool) else value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def sqlite_order(sort_by):
+    field, direction, _ = SORT_OPTIONS[sort_by]
+    order = "DESC" if direction < 0 else "ASC"
+    if field == "id":
+        return f" ORDER BY id {order}"
+    return f" ORDER BY {field} {order}, id {order}"
+
+
+class SqliteBackend(StorageBackend):
+    """Books in an embedded SQLite database.
+
+    The database runs in WAL mode, so readers never wait on the writer, and
+    every write is a transaction. Filters and sorts are served by the same
+    compound indexes as on MongoDB, and search by an FTS5 index weighted like
+    SEARCH_FIELDS (or LIKE matching where SQLite was built without FTS5).
+    Triggers record the id of every changed book in book_changes, which
+    other processes follow (see changefeed.SqliteChangeFeed).
+    Each thread gets its own connection.
+    """
+
+    name = "SQLite"
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.local = threading.local()
+        db = self.connection()
+        db.execute("PRAGMA journal_mode = WAL")
+        with db:
+            db.executescript(SQLITE_SCHEMA)
+            if "key" not in {row["name"] for row in db.execute("PRAGMA table_info(books)")}:
+                # Databases from before keys were kept; the rows get theirs from dedupe.py --merge.
+                db.execute("ALTER TABLE books ADD COLUMN key TEXT")
+            for columns in sqlite_index_columns():
+                db.execute(f"CREATE INDEX IF NOT EXISTS books_{'_'.join(columns)} ON books ({', '.join(columns)})")
+        try:
+            with db:
+                # NULL keys never collide, so books without one are not held back.
+                db.execute("CREATE UNIQUE INDEX IF NOT EXISTS books_key ON books (key)")
+        except sqlite3.IntegrityError:
+            self.warnings.append(DUPLICATES_WARNING)
+        try:
+            with db:
+                db.executescript(SQLITE_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            self.fts = False
+            self.warnings.append(f"SQLite full-text search is unavailable ({e}); search falls back to substring matching.")
+
+    def connection(self):
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            # Safe with WAL: a crash can only lose the last commits, never corrupt the database.
+            db.execute("PRAGMA synchronous = NORMAL")
+            self.local.db = db
+        return db
+
+    @staticmethod
+    def to_row(book):
+        return tuple(bool(book.get(column, False)) if column == "read" else book.get(column) for column in BOOK_COLUMNS)
+
+    @staticmethod
+    def to_book(row):
+        book = dict(zip(BOOK_COLUMNS, row))
+        book["read"] = bool(book["read"])
+        return book
+
+    def select(self, sql, params=()):
+        return [self.to_book(row) for row in self.connection().execute(sql, params)]
+
+    def load(self):
+        return [BookRecord(book) for book in self.select(f"SELECT {', '.join(BOOK_COLUMNS)} FROM books")]
+
+    def last_change(self):
+        return self.connection().execute("SELECT COALESCE(MAX(seq), 0) FROM book_changes").fetchone()[0]
+
+    def changes_since(self, seq):
+        """Returns (last seq, changed books, removed ids) for the changes
+        after seq, or None when some of them were already pruned."""
+        db = self.connection()
+        with db:
+            # One read transaction, so the books match the changes they follow.
+            db.execute("BEGIN")
+            oldest = db.execute("SELECT MIN(seq) FROM book_changes").fetchone()[0]
+            if oldest is not None and oldest > seq + 1:
+                return None
+            rows = db.execute("SELECT seq, id FROM book_changes WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+            if not rows:
+                return seq, [], []
+            ids = list(dict.fromkeys(row["id"] for row in rows))
+            books = []
+            for start in range(0, len(ids), LOAD_BATCH_SIZE):
+                batch = ids[start:start + LOAD_BATCH_SIZE]
+                books.extend(self.select(
+                    f"SELECT {', '.join(BOOK_COLUMNS)} FROM books WHERE id IN ({', '.join('?' * len(batch))})", batch
+                ))
+        found = {book['id'] for book in books}
+        return rows[-1]["seq"], books, [book_id for book_id in ids if book_id not in found]
+
+    def prune_changes(self, keep):
+        db = self.connection()
+        with db:
+            db.execute("DELETE FROM book_changes WHERE seq <= (SELECT MAX(seq) FROM book_changes) - ?", (keep,))
+
+    def insert(self, book):
+        self.insert_many([book])
+
+    def insert_many(self, books):
+        db = self.connection()
+        sql = f"INSERT INTO books ({', '.join(BOOK_COLUMNS)}) VALUES ({', '.join('?' * len(BOOK_COLUMNS))})"
+        try:
+            with db:
+                db.executemany(sql, [self.to_row(book) for book in books])
+            return
+        except sqlite3.IntegrityError as e:
+            if "books.key" not in str(e):
+                raise
+        # The batch was rolled back as a whole: insert it again a book at a
+        # time, leaving out only the duplicates.
+        refused = []
+        with db:
+            for book in books:
+                try:
+                    db.execute(sql, self.to_row(book))
+                except sqlite3.IntegrityError as e:
+                    if "books.key" not in str(e):
+                        raise
+                    refused.append(book)
+        if refused:
+            raise DuplicateBookError(refused_message(refused, len(books)), refused)
+
+    def delete(self, book_id):
+        db = self.connection()
+        with db:
+            return db.execute("DELETE FROM books WHERE id = ?", (book_id,)).rowcount > 0
+
+    def toggle(self, book_id):
+        db = self.connection()
+        with db:
+            # One statement, so concurrent toggles cannot overwrite each other.
+            if db.execute("UPDATE books SET read = NOT read WHERE id = ?", (book_id,)).rowcount == 0:
+                return None
+            return bool(db.execute("SELECT read FROM books WHERE id = ?", (book_id,)).fetchone()[0])
+
+    def set_read_many(self, book_ids, read):
+        db = self.connection()
+        with db:
+            return db.executemany("UPDATE books SET read = ? WHERE id = ?", [(bool(read), book_id) for book_id in book_ids]).rowcount
+
+    def delete_many(self, book_ids):
+        db = self.connection()
+        with db:
+            return db.executemany("DELETE FROM books WHERE id = ?", [(book_id,) for book_id in book_ids]).rowcount
+
+    def search_sql(self, search_term, search_by, limit=SEARCH_LIMIT):
+        # None when the term cannot match anything.
+        columns = ", ".join(f"books.{column}" for column in BOOK_COLUMNS)
+        if search_by == "year":
+            if not search_term.isdigit():
+                return None
+            return f"SELECT {columns} FROM books WHERE year = ? ORDER BY id LIMIT ?", (int(search_term), limit)
+        tokens = tokenize(search_term)
+        if not tokens:
+            return None
+        fields = list(SEARCH_FIELDS) if search_by == "all" else [search_by]
+        if not self.fts:
+            clauses = " AND ".join("(" + " OR ".join(f"{field} LIKE ?" for field in fields) + ")" for _ in tokens)
+            params = [f"%{token}%" for token in tokens for _ in fields]
+            return f"SELECT {columns} FROM books WHERE {clauses} ORDER BY title, id LIMIT ?", params + [limit]
+        # Tokens are \w+ only, so quoting them is enough to keep FTS5 syntax out.
+        # As in memory, every token but the last must match a whole word.
+        *whole, last = tokens
+        match = " ".join([f'"{token}"' for token in whole] + [f'"{last}"*'])
+        if search_by != "all":
+            match = f"{search_by} : ({match})"
+        weights = ", ".join(str(weight) for weight in SEARCH_FIELDS.values())
+        return (
+            f"SELECT {columns} FROM books_fts JOIN books ON books.rowid = books_fts.rowid "
+            f"WHERE books_fts MATCH ? ORDER BY bm25(books_fts, {weights}) LIMIT ?",
+            (match, limit),
+        )
+
+    def search(self, search_term, search_by, limit=SEARCH_LIMIT):
+        query = self.search_sql(search_term, search_by, limit)
+        return [] if query is None else self.select(*query)
+
+    @staticmethod
+    def count_sql(filter_status, filter_genre):
+        where, params = sqlite_where(filter_status, filter_genre)
+        return f"SELECT COUNT(*) FROM books{where}", params
+
+    def count(self, filter_status, filter_genre):
+        return self.connection().execute(*self.count_sql(filter_status, filter_genre)).fetchone()[0]
+
+    @staticmethod
+    def page_sql(filter_status, filter_genre, sort_by, page=1, page_size=None):
+        where, params = sqlite_where(filter_status, filter_genre)
+        sql = f"SELECT {', '.join(BOOK_COLUMNS)} FROM books{where}{sqlite_order(sort_by)}"
+        if page_size is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params += [page_size, (page - 1) * page_size]
+        return sql, params
+
+    def page(self, filter_status, filter_genre, sort_by, page=1, page_size=None):
+        return self.select(*self.page_sql(filter_status, filter_genre, sort_by, page, page_size))
+
+    def explain(self, method, args):
+        builders = {"search": self.search_sql, "count": self.count_sql, "page": self.page_sql}
+        query = builders[method](*args) if method in builders else None
+        if query is None:
+            return None
+        details = [row[3] for row in self.connection().execute(f"EXPLAIN QUERY PLAN {query[0]}", query[1])]
+        return {
+            "stages": " → ".join(details),
+            # A bare "SCAN books" reads the whole table; a temp b-tree is a sort the index did not cover.
+            "indexed": not any(detail == "SCAN books" or "TEMP B-TREE" in detail for detail in details),
+        }
+
+    def statistics(self):
+        db = self.connection()
+        with db:
+            # One read transaction, so every figure comes from the same snapshot.
+            db.execute("BEGIN")
+            total_books, read_books = db.execute("SELECT COUNT(*), COALESCE(SUM(read), 0) FROM books").fetchone()
+            genres = dict(db.execute("SELECT genre, COUNT(*) FROM books GROUP BY genre ORDER BY genre").fetchall())
+            decades = dict(db.execute(
+                "SELECT year - year % 10, COUNT(*) FROM books WHERE typeof(year) = 'integer' GROUP BY 1 ORDER BY 1"
+            ).fetchall())
+            authors = [tuple(row) for row in db.execute(
+                "SELECT author, COUNT(*) FROM books WHERE author != '' GROUP BY author ORDER BY 2 DESC, author LIMIT ?",
+                (TOP_AUTHORS,),
+            )]
+        return build_statistics(read_books, total_books, genres, decades, authors)
+
+    def genres(self):
+        return [row[0] for row in self.connection().execute("SELECT DISTINCT genre FROM books ORDER BY genre")]
+
+    def save(self, library):
+        db = self.connection()
+        with db:
+            db.execute("DELETE FROM books")
+            db.executemany(
+                f"INSERT INTO books ({', '.join(BOOK_COLUMNS)}) VALUES ({', '.join('?' * len(BOOK_COLUMNS))})",
+                [self.to_row(book) for book in library],
+            )
+        return len(library)
+
+    def iter_books(self, filter_status, filter_genre, sort_by):
+        where, params = sqlite_where(filter_status, filter_genre)
+        cursor = self.connection().execute(f"SELECT {', '.join(BOOK_COLUMNS)} FROM books{where}{sqlite_order(sort_by)}", params)
+        return (self.to_book(row) for row in cursor)
+
+    def ping(self):
+        self.connection().execute("SELECT 1 FROM books LIMIT 1").fetchall()
+
+    def apply_changes(self, entries):
+        updates = ", ".join(f"{column} = excluded.{column}" for column in BOOK_COLUMNS if column != "id")
+        db = self.connection()
+        rejected = []
+        with db:
+            for entry in entries:
+                try:
+                    self.apply_change(db, entry, updates)
+                except sqlite3.IntegrityError as e:
+                    # Only that statement is undone; the transaction goes on.
+                    if "books.key" not in str(e):
+                        raise
+                    rejected.append(entry)
+        return rejected
+
+    def apply_change(self, db, entry, updates):
+        if entry["op"] == "add":
+            # An upsert rather than INSERT OR REPLACE, which would skip the FTS delete trigger.
+            db.execute(
+                f"INSERT INTO books ({', '.join(BOOK_COLUMNS)}) VALUES ({', '.join('?' * len(BOOK_COLUMNS))}) "
+                f"ON CONFLICT (id) DO UPDATE SET {updates}",
+                self.to_row(entry["book"]),
+            )
+        elif entry["op"] == "remove":
+            db.execute("DELETE FROM books WHERE id = ?", (entry["id"],))
+        elif entry["op"] == "update":
+            fields = {column: value for column, value in entry["fields"].items() if column in BOOK_COLUMNS and column != "id"}
+            if fields:
+                assignments = ", ".join(f"{column} = ?" for column in fields)
+                db.execute(f"UPDATE books SET {assignments} WHERE id = ?", [*fields.values(), entry["id"]])
+
+
+class Outbox:
+    """Changes made while the primary backend was unreachable.
+
+    Kept on disk in the journal's line format until they have been replayed
+    to the backend, so they survive a restart during an outage.
+    """
+
+    def __init__(self, path, rejects_path=None):
+        self.path = path
+        # Changes the backend refused as duplicates of books stored during
+        # the outage; kept for review instead of being retried forever.
+        self.rejects_path = rejects_path or path + ".rejected"
+        self.lock = threading.RLock()
+        self.pending = len(read_changes(path))
+        self.rejected = 0
+
+    def append(self, entries):
+        with self.lock:
+            append_changes(self.path, entries)
+            self.pending += len(entries)
+
+    def replay(self, backend, batch_size=LOAD_BATCH_SIZE):
+        with self.lock:
+            entries = read_changes(self.path)
+            rejected = []
+            for start in range(0, len(entries), batch_size):
+                rejected.extend(backend.apply_changes(entries[start:start + batch_size]))
+            if rejected:
+                append_changes(self.rejects_path, rejected)
+                self.rejected += len(rejected)
+            # Only cleared once every batch is in; a crash before this replays
+            # them again, which apply_changes allows.
+            open(self.path, "w").close()
+            self.pending = 0
+            return len(entries)
+
+
+class CircuitBreaker:
+    """Fails fast while the primary backend is unreachable.
+
+    After failure_threshold failures in a row the breaker opens: callers stop
+    waiting on the backend, serve reads from the catalog and buffer writes in
+    the outbox. A background thread then pings the backend every
+    probe_interval seconds; once it answers, the outbox has been replayed and
+    on_recovery has run, the breaker closes.
+    """
+
+    def __init__(self, backend, outbox, failure_threshold=3, probe_interval=5.0, on_recovery=None):
+        self.backend = backend
+        self.outbox = outbox
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.on_recovery = on_recovery
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open = False
+        self.prober = None
+
+    def allow(self):
+        return not self.open
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return
+        self.trip()
+
+    def trip(self):
+        with self.lock:
+            self.open = True
+        self.start_probing()
+
+    def buffer(self, entries):
+        if not entries:
+            return
+        self.outbox.append(entries)
+        # The breaker may have closed since the caller found it open; the
+        # prober replays whatever was buffered after the last replay.
+        self.start_probing()
+
+    def start_probing(self):
+        with self.lock:
+            if self.prober is not None:
+                return
+            self.prober = threading.Thread(target=self.probe, name="library-breaker-probe", daemon=True)
+            self.prober.start()
+
+    def probe(self):
+        while True:
+            try:
+                self.backend.ping()
+                with self.outbox.lock:
+                    self.outbox.replay(self.backend)
+                    if self.open and self.on_recovery is not None:
+                        # Before closing and with writes held back, so the
+                        # catalog has caught up by the time reads move back.
+                        self.on_recovery()
+                    with self.lock:
+                        self.open = False
+                        self.failures = 0
+            except Exception:
+                time.sleep(self.probe_interval)
+                continue
+            with self.lock:
+                # Changes buffered since the replay need another pass.
+                if not self.outbox.pending:
+                    self.prober = None
+                    return
@@ -0,0 +1,193 @@
+"""Timing, size and slow-query telemetry for data-layer calls and rerun phases.
+
+Every measured call becomes a sample (wall time, documents, estimated
+bytes, success). Totals and latency histograms per call are kept for the
+life of the process and can be exported in the Prometheus text format;
+the most recent samples are kept for the Performance tab and can be
+exported, or logged as they happen, as JSON lines.
+"""
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from storage import BookRecord, encode_book
+
+
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+RECENT_SAMPLES = 5000
+SLOW_SAMPLES = 50
+SIZE_SAMPLE = 100
+
+
+def count_documents(result, args=()):
+    # Documents returned, or for writes, documents passed in.
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, (dict, BookRecord)):
+        return 1
+    for arg in args:
+        if isinstance(arg, list):
+            return len(arg)
+        if isinstance(arg, BookRecord):
+            return 1
+    return 0
+
+
+def estimate_bytes(result):
+    # JSON size of the returned documents, extrapolated from the first
+    # SIZE_SAMPLE so large loads are not serialized just to be measured.
+    if isinstance(result, (dict, BookRecord)):
+        result = [result]
+    if not isinstance(result, list) or not result:
+        return 0
+    sample = result[:SIZE_SAMPLE]
+    size = sum(len(json.dumps(book, default=encode_book)) for book in sample)
+    return size * len(result) // len(sample)
+
+
+def prometheus_labels(labels):
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+class Telemetry:
+    """Thread-safe sample store shared by every session.
+
+    A sample slower than slow_ms that measures a backend query is flagged as
+    slow; if an explain callable was given, its query plan summary is fetched
+    on a background thread and attached to the sample.
+    """
+
+    def __init__(self, slow_ms=500, log_path=None):
+        self.slow_ms = slow_ms
+        self.log_path = log_path
+        self.lock = threading.Lock()
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self.slow = deque(maxlen=SLOW_SAMPLES)
+        self.totals = {}
+
+    @contextmanager
+    def measure(self, name, kind="query", backend="", args=(), explain=None):
+        """Times the with-block. Call the yielded function with the block's
+        result to record its document count and size."""
+        outcome = {"result": None}
+        started = time.perf_counter()
+        ok = True
+        try:
+            yield lambda result: outcome.update(result=result)
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self.record(name, kind, backend, seconds, outcome["result"], args, ok, explain)
+
+    def record(self, name, kind, backend, seconds, result=None, args=(), ok=True, explain=None):
+        sample = {
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "kind": kind,
+            "name": name,
+            "backend": backend,
+            "ms": round(seconds * 1000, 3),
+            "documents": count_documents(result, args),
+            "bytes": estimate_bytes(result),
+            "ok": ok,
+        }
+        if kind == "query" and sample["ms"] >= self.slow_ms:
+            sample["slow"] = True
+        key = (kind, name, backend)
+        with self.lock:
+            totals = self.totals.get(key)
+            if totals is None:
+                totals = self.totals[key] = {
+                    "count": 0, "seconds": 0.0, "documents": 0, "bytes": 0, "errors": 0, "slow": 0,
+                    "buckets": [0] * len(LATENCY_BUCKETS),
+                }
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["documents"] += sample["documents"]
+            totals["bytes"] += sample["bytes"]
+            totals["errors"] += not ok
+            totals["slow"] += sample.get("slow", False)
+            for position, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    totals["buckets"][position] += 1
+            self.recent.append(sample)
+            if sample.get("slow"):
+                self.slow.append(sample)
+        if sample.get("slow") and explain is not None:
+            threading.Thread(target=self.attach_plan, args=(sample, explain), daemon=True).start()
+        if self.log_path:
+            with self.lock, open(self.log_path, "a") as file:
+                file.write(json.dumps(sample) + "\n")
+        return sample
+
+    @staticmethod
+    def attach_plan(sample, explain):
+        try:
+            sample["plan"] = explain()
+        except Exception as e:
+            sample["plan"] = {"error": str(e)}
+
+    def summary(self):
+        """One row per call: counts, totals and percentiles of the recent samples."""
+        with self.lock:
+            totals = {key: dict(value) for key, value in self.totals.items()}
+            recent = list(self.recent)
+        latencies = {}
+        for sample in recent:
+            latencies.setdefault((sample["kind"], sample["name"], sample["backend"]), []).append(sample["ms"])
+        rows = []
+        for (kind, name, backend), value in sorted(totals.items()):
+            samples = sorted(latencies.get((kind, name, backend), [0]))
+            rows.append({
+                "kind": kind,
+                "name": name,
+                "backend": backend,
+                "calls": value["count"],
+                "mean_ms": round(value["seconds"] * 1000 / value["count"], 3),
+                "p50_ms": samples[len(samples) // 2],
+                "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "documents": value["documents"],
+                "bytes": value["bytes"],
+                "errors": value["errors"],
+                "slow": value["slow"],
+            })
+        return rows
+
+    def prometheus(self):
+        with self.lock:
+            totals = {key: dict(value, buckets=list(value["buckets"])) for key, value in self.totals.items()}
+        lines = [
+            "# HELP library_call_seconds Wall time of data-layer calls and rerun phases.",
+            "# TYPE library_call_seconds histogram",
+        ]
+        for (kind, name, backend), value in sorted(totals.items()):
+            labels = {"kind": kind, "name": name, "backend": backend}
+            for bound, count in zip(LATENCY_BUCKETS, value["buckets"]):
+                lines.append(f"library_call_seconds_bucket{prometheus_labels({**labels, 'le': bound})} {count}")
+            lines.append(f"library_call_seconds_bucket{prometheus_labels({**labels, 'le': '+Inf'})} {value['count']}")
+            lines.append(f"library_call_seconds_sum{prometheus_labels(labels)} {value['seconds']:.6f}")
+            lines.append(f"library_call_seconds_count{prometheus_labels(labels)} {value['count']}")
+        for metric, field, help_text in [
+            ("library_call_documents_total", "documents", "Documents returned (or written) by data-layer calls."),
+            ("library_call_bytes_total", "bytes", "Estimated JSON bytes returned by data-layer calls."),
+            ("library_call_errors_total", "errors", "Data-layer calls that raised."),
+            ("library_slow_calls_total", "slow", "Backend queries slower than the slow-query threshold."),
+        ]:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for (kind, name, backend), value in sorted(totals.items()):
+                lines.append(f"{metric}{prometheus_labels({'kind': kind, 'name': name, 'backend': backend})} {value[field]}")
+        return "\n".join(lines) + "\n"
+
+    def json_lines(self):
+        with self.lock:
+            recent = list(self.recent)
+        return "".join(json.dumps(sample) + "\n" for sample in recent)